@@ -0,0 +1,186 @@
+"""
+Match reporting and stats aggregation benchmarks on in-memory fakes, no Google credentials needed.
+
+    python -m benchmarks.bench_hot_path --matches 5000 --players 200
+"""
+from benchmarks.fakes import FakeUser, InMemoryTournament, make_report
+from reports import parse_game
+from spreadsheets import SpreadsheetGameLogger
+import argparse
+import asyncio
+import journal
+import random
+import statistics
+import tempfile
+import time
+import tracemalloc
+import unmatched
+
+RATINGS = {'empty': None, 'counter': 'counter', 'ladder': 'ladder'}
+
+
+def measure(name, count, setup):
+    """
+    Run setup() twice: once for the timing, once under tracemalloc for the allocations
+    """
+    results = []
+    for traced in (False, True):
+        func = setup()
+        if traced:
+            tracemalloc.start()
+        start = time.perf_counter()
+        res = func()
+        if asyncio.iscoroutine(res):
+            asyncio.run(res)
+        elapsed = time.perf_counter() - start
+        if traced:
+            current, peak = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+            results += [current, peak]
+        else:
+            results.append(elapsed)
+    elapsed, current, peak = results
+    print(f'{name:<34}{count:>8}{elapsed:>10.3f}{elapsed / max(count, 1) * 1e6:>12.1f}'
+          f'{current / 1024:>12.0f}{peak / 1024:>12.0f}')
+
+
+def make_config(rating):
+    cfg = {'characters': 'all', 'boards': 'all'}
+    if rating is not None:
+        cfg['rating'] = rating
+    return cfg
+
+
+def typo(word, rnd):
+    if len(word) < 4 or rnd.random() < 0.5:
+        return word
+    pos = rnd.randrange(len(word))
+    return word[:pos] + word[pos + 1:]
+
+
+def make_season(matches, players, seed):
+    rnd = random.Random(seed)
+    roster = unmatched.get_roster()
+    users = [FakeUser(100000 + i, 'player' + str(i)) for i in range(players)]
+    messages = []
+    for _ in range(matches):
+        winner, loser = rnd.sample(users, 2)
+        win_char, lose_char = rnd.sample(roster.characters, 2)
+        board = rnd.choice(roster.boards)
+        messages.append(make_report(winner, loser,
+                                    typo(rnd.choice(win_char['aliases'] + [win_char['name']]), rnd),
+                                    typo(rnd.choice(lose_char['aliases'] + [lose_char['name']]), rnd),
+                                    typo(board['name'], rnd), rnd.random() < 0.5))
+    return messages
+
+
+def make_tables(sheets, rows, seed):
+    rnd = random.Random(seed)
+    roster = unmatched.get_roster()
+    chars = [x['name'] for x in roster.characters]
+    boards = [x['name'] for x in roster.boards]
+    tables = []
+    for _ in range(sheets):
+        tables.append([['01.01.2024 00:00:00', 'a', 'b'] + rnd.sample(chars, 2) + [rnd.choice(boards), '', '+']
+                       for _ in range(rows)])
+    return tables
+
+
+def bench_reporting(args):
+    messages = make_season(args.matches, args.players, args.seed)
+    parsed = [parse_game(m) for m in messages]
+
+    def parse():
+        unmatched.reload_roster()
+        return lambda: [parse_game(m) for m in messages]
+    measure('parse_game (cold roster)', len(messages), parse)
+    measure('parse_game (warm roster)', len(messages), lambda: lambda: [parse_game(m) for m in messages])
+
+    for name, rating in RATINGS.items():
+        def report():
+            journal.JOURNAL_DIR = tempfile.mkdtemp()
+            tour = InMemoryTournament([])
+            asyncio.run(tour.start_with_config('bench', make_config(rating)))
+
+            async def run():
+                for match in parsed:
+                    await tour.report_match(match)
+            return run
+        measure('report_match [' + name + ']', len(parsed), report)
+
+        def replay():
+            tour = InMemoryTournament([])
+            asyncio.run(tour.start_with_config('bench', make_config(rating)))
+            manager = tour.rating
+            ranks = {}
+
+            def run():
+                for match in parsed:
+                    if match.winner not in ranks:
+                        ranks[match.winner] = manager.default_rank()
+                    if match.loser not in ranks:
+                        ranks[match.loser] = manager.default_rank()
+                    w_rank, l_rank = ranks[match.winner], ranks[match.loser]
+                    ranks[match.winner], ranks[match.loser] = manager.update_rank(w_rank, l_rank)
+            return run
+        measure('update_rank [' + name + ']', len(parsed), replay)
+
+        journal.JOURNAL_DIR = tempfile.mkdtemp()
+        season = InMemoryTournament([])
+        asyncio.run(season.start_with_config('bench', make_config(rating)))
+
+        async def fill():
+            for match in parsed:
+                await season.report_match(match)
+        asyncio.run(fill())
+
+        def export():
+            return lambda: [SpreadsheetGameLogger.make_standings(season.sorted_standings()) for _ in range(100)]
+        measure('standings export [' + name + ']', 100, export)
+
+        def restore_full():
+            journal.JOURNAL_DIR = tempfile.mkdtemp()
+            tour = InMemoryTournament(season.logger.rows)
+            return lambda: tour.start_with_config('bench', make_config(rating))
+        measure('restore from sheet [' + name + ']', len(parsed), restore_full)
+
+        def restore_snapshot():
+            tour = InMemoryTournament(season.logger.rows)
+            return lambda: tour.start_with_config('bench', make_config(rating))
+        measure('restore from snapshot [' + name + ']', len(parsed), restore_snapshot)
+
+
+def bench_stats(args):
+    tables = make_tables(args.sheets, args.rows, args.seed)
+    parts = []
+
+    def aggregate():
+        parts.clear()
+
+        def run():
+            for rows in tables:
+                part = statistics.SheetStats()
+                part.add_rows(rows)
+                parts.append(part)
+        return run
+    measure('SheetStats.add_rows', args.sheets * args.rows, aggregate)
+    measure('MatchupMatrix', args.sheets * args.rows,
+            lambda: lambda: statistics.MatchupMatrix(unmatched.get_roster(), parts))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--matches', type=int, default=2000)
+    parser.add_argument('--players', type=int, default=100)
+    parser.add_argument('--sheets', type=int, default=50)
+    parser.add_argument('--rows', type=int, default=500)
+    parser.add_argument('--seed', type=int, default=1)
+    args = parser.parse_args()
+
+    print(f'{"stage":<34}{"ops":>8}{"total, s":>10}{"per op, us":>12}{"kept, KiB":>12}{"peak, KiB":>12}')
+    bench_reporting(args)
+    bench_stats(args)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,60 @@
+from spreadsheets import SpreadsheetGameLogger
+import unmatched
+
+
+class InMemoryGameLogger:
+    """
+    Stand-in for SpreadsheetGameLogger that keeps the log sheet in a list
+    """
+    def __init__(self, rows=None):
+        self.rows = rows if rows is not None else []
+        self.standings = []
+
+    async def log_match_async(self, match, is_rated):
+        row = SpreadsheetGameLogger.make_row(match, is_rated)
+        self.rows.append(row)
+        return row
+
+    async def update_standings_async(self, standings):
+        self.standings = SpreadsheetGameLogger.make_standings(standings)
+
+    async def load_log_async(self, start=0):
+        return [list(row) for row in self.rows[start:]]
+
+    async def load_results_async(self, get_stats=False):
+        if not get_stats:
+            return [[r[1], r[2]] for r in self.rows]
+        else:
+            return [[r[3], r[4]] for r in self.rows]
+
+
+class InMemoryTournament(unmatched.Tournament):
+    def __init__(self, rows=None):
+        super().__init__()
+        self.rows = rows
+
+    def make_logger(self, cfg):
+        return InMemoryGameLogger(self.rows)
+
+
+class FakeUser:
+    def __init__(self, id, name):
+        self.id = id
+        self.name = name
+        self.mention = '<@' + str(id) + '>'
+
+
+class FakeMessage:
+    def __init__(self, content, mentions, author):
+        self.content = content
+        self.mentions = mentions
+        self.author = author
+
+
+def make_report(winner, loser, win_char, lose_char, board, winner_first):
+    first, second = (winner, loser) if winner_first else (loser, winner)
+    content = '\n'.join([winner.mention + ' defeated ' + loser.mention,
+                         win_char + ' vs ' + lose_char,
+                         board,
+                         first.mention + ' first, ' + second.mention + ' second'])
+    return FakeMessage(content, [winner, loser], winner)
@@ -0,0 +1,165 @@
+from array import array
+from collections import Counter
+from datetime import date
+
+
+class Interner:
+    """
+    Dense ids for repeated strings, so matches are stored as small integers
+    """
+    def __init__(self):
+        self.ids = {}
+        self.names = []
+
+    def __len__(self):
+        return len(self.names)
+
+    def add(self, name):
+        id = self.ids.get(name)
+        if id is None:
+            id = len(self.names)
+            self.ids[name] = id
+            self.names.append(name)
+        return id
+
+    def get(self, name):
+        return self.ids.get(name)
+
+
+def row_day(row, default=0):
+    """
+    Ordinal of the date a log row was written on, default if it has none
+    """
+    try:
+        day, month, year = row[0][:10].split('.')
+        return date(int(year), int(month), int(day)).toordinal()
+    except (ValueError, IndexError, TypeError, AttributeError):
+        return default
+
+
+class MatchHistory:
+    """
+    Every match of a tournament in parallel typed arrays, with per-player match lists,
+    head-to-head scores and hero and board usage kept up to date as matches are added
+    """
+    def __init__(self):
+        self.players = Interner()
+        self.heroes = Interner()
+        self.boards = Interner()
+        self.days = array('I')
+        self.winners = array('i')
+        self.losers = array('i')
+        self.win_heroes = array('i')
+        self.lose_heroes = array('i')
+        self.match_boards = array('i')
+        # player id -> array of match indices
+        self.matches = {}
+        # (player id, opponent id) -> wins of the first against the second
+        self.h2h = {}
+        # player id -> {hero id: [wins, losses]}
+        self.hero_usage = {}
+        # player id -> {board id: [wins, losses]}
+        self.board_usage = {}
+
+    def __len__(self):
+        return len(self.winners)
+
+    def add_row(self, row):
+        if len(row) < 6:
+            return
+        index = len(self.winners)
+        winner = self.players.add(row[1])
+        loser = self.players.add(row[2])
+        win_hero = self.heroes.add(row[3])
+        lose_hero = self.heroes.add(row[4])
+        board = self.boards.add(row[5])
+        self.days.append(row_day(row))
+        self.winners.append(winner)
+        self.losers.append(loser)
+        self.win_heroes.append(win_hero)
+        self.lose_heroes.append(lose_hero)
+        self.match_boards.append(board)
+
+        for player in (winner, loser):
+            if player not in self.matches:
+                self.matches[player] = array('i')
+                self.hero_usage[player] = {}
+                self.board_usage[player] = {}
+            self.matches[player].append(index)
+        self.h2h[(winner, loser)] = self.h2h.get((winner, loser), 0) + 1
+        self.hero_usage[winner].setdefault(win_hero, [0, 0])[0] += 1
+        self.hero_usage[loser].setdefault(lose_hero, [0, 0])[1] += 1
+        self.board_usage[winner].setdefault(board, [0, 0])[0] += 1
+        self.board_usage[loser].setdefault(board, [0, 0])[1] += 1
+
+    def add_rows(self, rows):
+        for row in rows:
+            self.add_row(row)
+
+    def signatures(self, since_day=0):
+        """
+        Counts of (winner, loser, hero, opponent hero, board) over matches played on since_day or later.
+        Days are not sorted, backfilled matches are appended with their original dates
+        """
+        res = Counter()
+        names = self.players.names
+        heroes = self.heroes.names
+        for index, day in enumerate(self.days):
+            if day < since_day:
+                continue
+            res[(names[self.winners[index]], names[self.losers[index]], heroes[self.win_heroes[index]],
+                 heroes[self.lose_heroes[index]], self.boards.names[self.match_boards[index]])] += 1
+        return res
+
+    def last_day(self):
+        return max(self.days, default=0)
+
+    def games(self, player):
+        id = self.players.get(player)
+        return len(self.matches[id]) if id is not None else 0
+
+    def last_matches(self, player, count):
+        """
+        Up to count latest matches of a player as (day, won, opponent, hero, opponent hero, board), newest first
+        """
+        id = self.players.get(player)
+        if id is None:
+            return []
+        res = []
+        for index in reversed(self.matches[id][-count:]):
+            won = self.winners[index] == id
+            opponent = self.losers[index] if won else self.winners[index]
+            hero, opp_hero = self.win_heroes[index], self.lose_heroes[index]
+            if not won:
+                hero, opp_hero = opp_hero, hero
+            res.append((date.fromordinal(self.days[index]) if self.days[index] else None, won,
+                        self.players.names[opponent], self.heroes.names[hero], self.heroes.names[opp_hero],
+                        self.boards.names[self.match_boards[index]]))
+        return res
+
+    def head_to_head(self, player1, player2):
+        """
+        Wins of player1 against player2 and of player2 against player1
+        """
+        id1 = self.players.get(player1)
+        id2 = self.players.get(player2)
+        if id1 is None or id2 is None:
+            return 0, 0
+        return self.h2h.get((id1, id2), 0), self.h2h.get((id2, id1), 0)
+
+    def __usage(self, usage, names, player):
+        id = self.players.get(player)
+        if id is None:
+            return []
+        res = [(names.names[item], wins, losses) for item, (wins, losses) in usage[id].items()]
+        res.sort(key=lambda x: -(x[1] + x[2]))
+        return res
+
+    def hero_stats(self, player):
+        """
+        (hero, wins, losses) of a player, most played first
+        """
+        return self.__usage(self.hero_usage, self.heroes, player)
+
+    def board_stats(self, player):
+        return self.__usage(self.board_usage, self.boards, player)
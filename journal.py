@@ -0,0 +1,59 @@
+import json
+import os
+from utils import ROOT_DIR
+
+JOURNAL_DIR = os.path.join(ROOT_DIR, 'resources/journal')
+
+
+class TournamentJournal:
+    """
+    Local copy of a tournament log (one sheet row per line) and the latest standings snapshot
+    """
+    def __init__(self, name):
+        self.journal_path = os.path.join(JOURNAL_DIR, name + '.jsonl')
+        self.snapshot_path = os.path.join(JOURNAL_DIR, name + '.snapshot.json')
+        self.size = 0
+
+    def read(self):
+        rows = []
+        if os.path.isfile(self.journal_path):
+            with open(self.journal_path, 'r', encoding='utf-8') as fin:
+                for line in fin:
+                    # A torn last line means the process died mid-write, the sheet still has the row
+                    try:
+                        rows.append(json.loads(line))
+                    except ValueError:
+                        break
+        self.size = len(rows)
+        return rows
+
+    def append(self, rows):
+        if not rows:
+            return
+        os.makedirs(JOURNAL_DIR, exist_ok=True)
+        with open(self.journal_path, 'a', encoding='utf-8') as fout:
+            for row in rows:
+                fout.write(json.dumps(row, ensure_ascii=False) + '\n')
+            fout.flush()
+            os.fsync(fout.fileno())
+        self.size += len(rows)
+
+    def reset(self):
+        for path in (self.journal_path, self.snapshot_path):
+            if os.path.isfile(path):
+                os.remove(path)
+        self.size = 0
+
+    def load_snapshot(self):
+        try:
+            with open(self.snapshot_path, 'r', encoding='utf-8') as fin:
+                return json.load(fin)
+        except (OSError, ValueError):
+            return None
+
+    def dump_snapshot(self, data):
+        os.makedirs(JOURNAL_DIR, exist_ok=True)
+        tmp_path = self.snapshot_path + '.tmp'
+        with open(tmp_path, 'w', encoding='utf-8') as fout:
+            json.dump(data, fout, ensure_ascii=False)
+        os.replace(tmp_path, self.snapshot_path)
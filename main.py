@@ -1,40 +1,141 @@
+# Imported first, so the startup report covers the imports below
+from utils import ROOT_DIR, STARTUP
+import asyncio
+from collections import OrderedDict
+import csv
 import discord
 from discord.ext import commands
 from config import settings
 import os
-import re
 import unmatched
+import io
 import random
+import re
 import string
 import state
+from spreadsheets import flush_spooled_writes
+from metrics import METRICS
+import metrics
+import projection
+import profiling
+import time
+from reports import parse_game, confirms, find_unrecorded, DRAGON
 from datetime import datetime
-from utils import ROOT_DIR
-from statistics import StatsLoader
-from threading import RLock
+
+STARTUP.phase('imports')
 
 bot_intents = discord.Intents.default()
 bot_intents.message_content = True
-bot = commands.Bot(command_prefix=settings['prefix'], intents=bot_intents)
-secret = ''
+# Several shard processes can share a host: SHARD_COUNT and SHARD_IDS (comma separated) pick this one's shards
+shard_count = int(os.environ['SHARD_COUNT']) if 'SHARD_COUNT' in os.environ else settings.get('shard_count')
+shard_ids = [int(x) for x in os.environ['SHARD_IDS'].split(',')] if 'SHARD_IDS' in os.environ \
+    else settings.get('shard_ids')
+# Reactions are handled as raw events, so the bot needs no message cache
+bot = commands.AutoShardedBot(command_prefix=settings['prefix'], intents=bot_intents, max_messages=None,
+                              shard_count=shard_count, shard_ids=shard_ids)
 random.seed(datetime.now().timestamp())
-admins = []
+# Running tournaments by channel id
 tournaments = {}
-stats_loader = StatsLoader()
+# Channels whose tournaments are still being restored: channel id -> (name, event set once loading is over)
+loading = {}
+# Built on first use, the stats loader pulls in NumPy
+stats_loader = None
+warm_up_task = None
+LOAD_PARALLELISM = 4
+# Most played heroes and boards shown by !my_heroes
+MY_HEROES_TOP = 10
+LOADING_REPLY = 'Турнир в этом канале еще загружается, попробуйте через минуту'
+STATS_UNAVAILABLE_REPLY = 'Статистика пока недоступна, попробуйте позже'
+STARTUP.phase('bot setup')
+
+
+def get_stats_loader():
+    global stats_loader
+    if stats_loader is None:
+        from statistics import StatsLoader
+        stats_loader = StatsLoader()
+    return stats_loader
+
+
+def warm_up():
+    """
+    Heavy imports and the roster index, done in a worker thread while the gateway connects
+    """
+    unmatched.get_roster()
+    import google.oauth2.service_account
+    import google_auth_httplib2
+    import googleapiclient.discovery
+    import numpy
+    import statistics
+
+
+async def restore_tournament(channel, name, semaphore):
+    try:
+        async with semaphore:
+            tour = unmatched.Tournament()
+            await tour.start(name)
+            tournaments[channel.id] = tour
+            if channel.guild is not None:
+                # Fills in the guild for tournaments migrated from state.json
+                state.add_tournament(channel.id, channel.guild.id, name)
+    except Exception as err:
+        print(err)
+        try:
+            await channel.send('Не удалось восстановить турнир ' + name + ': ' + str(err))
+        except discord.HTTPException as send_err:
+            print(send_err)
+    finally:
+        loading.pop(channel.id)[1].set()
 
 
-def load_tournaments():
-    data = state.load_state()
-    for ch_id, name in data:
+def register_tournaments():
+    """
+    Marks saved tournaments as loading before anything is awaited, so reactions and commands
+    wait for them instead of finding no tournament
+    """
+    registered = []
+    for ch_id, name in state.load_state(bot.shard_ids, bot.shard_count):
+        if ch_id in tournaments or ch_id in loading:
+            continue
+        loading[ch_id] = (name, asyncio.Event())
+        registered.append((ch_id, name))
+    return registered
+
+
+async def load_tournaments(registered):
+    semaphore = asyncio.Semaphore(LOAD_PARALLELISM)
+    jobs = []
+    for ch_id, name in registered:
         channel = bot.get_channel(ch_id)
         if not channel:
             print(f'Channel {ch_id} not found')
+            loading.pop(ch_id)[1].set()
             continue
-        tour = unmatched.Tournament()
-        try:
-            tour.start(name)
-            tournaments[channel] = tour
-        except Exception as err:
-            print(err)
+        jobs.append(restore_tournament(channel, name, semaphore))
+    await asyncio.gather(*jobs)
+
+
+def tournament_label(channel_id):
+    if channel_id in tournaments:
+        return tournaments[channel_id].name
+    if channel_id in loading:
+        return loading[channel_id][0]
+    return '-'
+
+
+@bot.before_invoke
+async def start_command_timer(ctx):
+    ctx.started_at = time.perf_counter()
+    profiling.set_command(ctx.command.name)
+
+
+@bot.after_invoke
+async def stop_command_timer(ctx):
+    METRICS.observe('bot_command_seconds', time.perf_counter() - getattr(ctx, 'started_at', time.perf_counter()),
+                    command=ctx.command.name, tournament=tournament_label(ctx.channel.id),
+                    status='error' if ctx.command_failed else 'ok')
+    profiling.clear_command()
+
 
 @bot.command()
 async def hello(ctx):
@@ -50,8 +151,8 @@ async def tell_me_secret(ctx):
     """
     Only dragons should use this, not people
     """
-    global secret
     secret = ''.join(random.choices(string.ascii_uppercase + string.digits, k=15))
+    state.set_secret(secret)
     path = os.path.join(ROOT_DIR, 'secret.txt')
     with open(path, 'w') as fout:
         print(secret, file=fout)
@@ -63,8 +164,8 @@ async def obey_my_command(ctx, arg):
     """
     Claim admin rights, if you are worthy
     """
-    if arg == secret:
-        admins.append(ctx.author)
+    if arg == state.get_secret():
+        state.add_admin(ctx.author.id)
         await ctx.send('К вашим услугам')
     else:
         await ctx.send('Я так не думаю')
@@ -75,20 +176,182 @@ async def bow(ctx):
     """
     Check if you have admin rights
     """
-    if ctx.author in admins:
+    if state.is_admin(ctx.author.id):
         await ctx.send('Слушаюсь и повинуюсь')
     else:
         await ctx.send('Я не склонюсь ни перед кем!')
 
 
+@bot.command(name='metrics')
+async def show_metrics(ctx):
+    """
+    Show latency and outcome metrics, requires admin rights
+    """
+    if not state.is_admin(ctx.author.id):
+        await ctx.send('Недостаточно прав')
+        return
+    summary = (METRICS.summary() or 'Пока ничего не измерено') + '\n\nStartup:\n' + STARTUP.render()
+    if len(summary) > 1900:
+        summary = summary[:1900] + '\n...'
+    await ctx.send('```\n' + summary + '\n```')
+
+
+@bot.command()
+async def profile(ctx, seconds='10'):
+    """
+    Profile everything the bot does for the given number of seconds, requires admin rights
+    """
+    if not state.is_admin(ctx.author.id):
+        await ctx.send('Недостаточно прав')
+        return
+    if not seconds.isdigit() or not 0 < int(seconds) <= 300:
+        await ctx.reply('Укажите число секунд (до 300)')
+        return
+    await ctx.send('Профилирую ' + seconds + ' с')
+    res = await profiling.PROFILER.profile(int(seconds))
+    if res is None:
+        await ctx.reply('Профилирование уже идет')
+        return
+    summary, path = res
+    if len(summary) > 1900:
+        summary = summary[:1900] + '\n...'
+    await ctx.reply('```\n' + summary + '\n```', file=discord.File(path))
+
+
 @bot.command()
 async def statistics(ctx):
     """
     Retrieve character stats for all tournaments
     """
-    await ctx.send('Начинаю сбор статистики')
-    stats_file = stats_loader.load_stats()
-    await ctx.send(file=discord.File(stats_file))
+    loader = get_stats_loader()
+    if not loader.ready():
+        await ctx.send('Начинаю сбор статистики')
+    stats_file = await loader.load_stats()
+    if stats_file is None:
+        await ctx.reply(STATS_UNAVAILABLE_REPLY)
+        return
+    await ctx.send(files=[discord.File(stats_file), discord.File(loader.winrates_path)])
+
+
+async def get_matrix(ctx):
+    """
+    Matchup matrix of the stats, None after replying that there are none yet
+    """
+    loader = get_stats_loader()
+    if loader.matrix is None:
+        loader.reload()
+    if loader.matrix is None:
+        await ctx.send('Начинаю сбор статистики')
+        if await loader.load_stats() is None:
+            await ctx.reply(STATS_UNAVAILABLE_REPLY)
+            return None
+    return loader.matrix
+
+
+def format_score(wins, losses):
+    if wins + losses == 0:
+        return '0:0'
+    return f'{wins}:{losses} ({round(100 * wins / (wins + losses))}%)'
+
+
+def format_ranked(ranked):
+    return '\n'.join(f'  {name} {format_score(wins, losses)}' for name, wins, losses in ranked)
+
+
+@bot.command()
+async def matchup(ctx, *, arg):
+    """
+    Score of character1 against character2 over all tournaments, names with spaces are split by "vs"
+    """
+    # Same format as the heroes line of a report, two one-word names may go without "vs"
+    names = re.split(r'\s+vs\s+', arg.strip(), flags=re.IGNORECASE)
+    if len(names) == 1:
+        names = arg.split()
+    if len(names) != 2:
+        await ctx.reply('Укажите двух персонажей: персонаж1 vs персонаж2')
+        return
+    char1 = unmatched.get_roster().parse_character(names[0])
+    char2 = unmatched.get_roster().parse_character(names[1])
+    if char1 == char2:
+        await ctx.reply('Укажите двух разных персонажей: персонаж1 vs персонаж2')
+        return
+    matrix = await get_matrix(ctx)
+    if matrix is None:
+        return
+    try:
+        wins, losses = matrix.matchup(char1, char2)
+    except KeyError:
+        await ctx.reply('Статистика еще не обновилась после смены ростера')
+        return
+    await ctx.reply(f'{char1} против {char2}: {format_score(wins, losses)}')
+
+
+@bot.command()
+async def hero_stats(ctx, *, arg):
+    """
+    Character score with best and worst matchups over all tournaments
+    """
+    matrix = await get_matrix(ctx)
+    if matrix is None:
+        return
+    char = unmatched.get_roster().parse_character(arg)
+    try:
+        wins, losses, best, worst = matrix.hero_stats(char)
+    except KeyError:
+        await ctx.reply('Статистика еще не обновилась после смены ростера')
+        return
+    await ctx.reply(f'{char}: {format_score(wins, losses)}\n'
+                    f'Лучшие матчапы:\n{format_ranked(best)}\n'
+                    f'Худшие матчапы:\n{format_ranked(worst)}')
+
+
+@bot.command()
+async def board_stats(ctx, *, arg):
+    """
+    Best and worst characters on a board over all tournaments
+    """
+    matrix = await get_matrix(ctx)
+    if matrix is None:
+        return
+    board = unmatched.get_roster().parse_board(arg)
+    try:
+        games, best, worst = matrix.board_stats(board)
+    except KeyError:
+        await ctx.reply('Статистика еще не обновилась после смены ростера')
+        return
+    await ctx.reply(f'{board}: сыграно игр - {games}\n'
+                    f'Лучшие персонажи:\n{format_ranked(best)}\n'
+                    f'Худшие персонажи:\n{format_ranked(worst)}')
+
+
+@bot.command()
+async def ratings(ctx, system='elo', arg='10'):
+    """
+    Top players by Elo or Glicko-2 rating over all tournaments
+    """
+    if system not in ('elo', 'glicko'):
+        await ctx.reply('Доступные рейтинги: elo, glicko')
+        return
+    if not arg.isdigit() or int(arg) < 1:
+        await ctx.reply('Укажите число игроков')
+        return
+    if await get_matrix(ctx) is None:
+        return
+    rated = get_stats_loader().player_ratings(system) or []
+    count = min(int(arg), 30)
+    lines = [f'{place}. {player} - {rank}' for place, (player, rank) in enumerate(rated[:count], 1)]
+    if not lines:
+        await ctx.reply('Еще никто не играл')
+        return
+    if count >= len(rated) or count == int(arg):
+        await ctx.reply('\n'.join(lines))
+        return
+    # The full table doesn't fit in a message
+    out = io.StringIO()
+    csv.writer(out).writerows([place, player, str(rank)] for place, (player, rank) in enumerate(rated, 1))
+    lines.append('Полная таблица - в файле')
+    await ctx.reply('\n'.join(lines), file=discord.File(io.BytesIO(out.getvalue().encode('utf-8')),
+                                                         filename=f'ratings_{system}.csv'))
 
 
 @bot.command()
@@ -96,17 +359,21 @@ async def tournament(ctx, arg):
     """
     Start a new tournament, requires admin rights and config file
     """
-    if ctx.author not in admins:
+    if not state.is_admin(ctx.author.id):
         await ctx.send('Недостаточно прав для проведения соревнования')
         return
-    if ctx.channel in tournaments:
+    if ctx.channel.id in loading:
+        await ctx.send(LOADING_REPLY)
+        return
+    if ctx.channel.id in tournaments:
         await ctx.send('В этом канале уже проходит соревнование')
         return
 
     try:
         tour = unmatched.Tournament()
-        tour.start(arg)
-        tournaments[ctx.channel] = tour
+        await tour.start(arg)
+        tournaments[ctx.channel.id] = tour
+        state.add_tournament(ctx.channel.id, ctx.guild.id if ctx.guild else None, arg)
     except unmatched.UMException as err:
         await ctx.send('Ошибка при создании соревнования: ' + str(err))
         return
@@ -115,7 +382,6 @@ async def tournament(ctx, arg):
         print(err)
         return
 
-    state.dump_state(tournaments)
     await ctx.send('Турнир ' + arg + ' начался. И пусть победит сильнейший!')
 
 
@@ -124,18 +390,21 @@ async def stop_tournament(ctx):
     """
     Stop tournament currently running in this channel, requires admin rights
     """
-    if ctx.author not in admins:
+    if not state.is_admin(ctx.author.id):
         await ctx.send('Недостаточно прав для завершения соревнования')
         return
-    if ctx.channel not in tournaments:
+    if ctx.channel.id in loading:
+        await ctx.send(LOADING_REPLY)
+        return
+    if ctx.channel.id not in tournaments:
         await ctx.send('В этом канале нет соревнования')
         return
 
-    name = tournaments[ctx.channel].name
-    winners = '\n'.join(tournaments[ctx.channel].get_winners())
+    name = tournaments[ctx.channel.id].name
+    winners = '\n'.join(tournaments[ctx.channel.id].get_winners())
 
-    del tournaments[ctx.channel]
-    state.dump_state(tournaments)
+    del tournaments[ctx.channel.id]
+    state.remove_tournament(ctx.channel.id)
     await ctx.send('Соревнование ' + name + ' завершено. Слава победителям!\n' + winners)
 
 
@@ -144,7 +413,7 @@ async def reload(ctx):
     """
     Reload roster, requires admin rights
     """
-    if ctx.author not in admins:
+    if not state.is_admin(ctx.author.id):
         await ctx.send('Недостаточно прав для завершения соревнования')
         return
     unmatched.reload_roster()
@@ -156,111 +425,383 @@ async def my_rank(ctx):
     """
     Shows your rank in current tournament
     """
-    if ctx.channel in tournaments:
-        await ctx.reply('Ранг - ' + tournaments[ctx.channel].get_rank(ctx.author.name))
+    if ctx.channel.id in loading:
+        await ctx.reply(LOADING_REPLY)
+    elif ctx.channel.id in tournaments:
+        await ctx.reply('Ранг - ' + tournaments[ctx.channel.id].get_rank(ctx.author.name))
+    else:
+        await ctx.reply('В этом канале нет соревнования')
+
+
+@bot.command()
+async def my_place(ctx):
+    """
+    Shows your place in current tournament
+    """
+    if ctx.channel.id in loading:
+        await ctx.reply(LOADING_REPLY)
+    elif ctx.channel.id in tournaments:
+        place = tournaments[ctx.channel.id].get_place(ctx.author.name)
+        if place is None:
+            await ctx.reply('Вы еще не сыграли ни одной игры')
+        else:
+            await ctx.reply('Место - ' + str(place) + ' из ' + str(len(tournaments[ctx.channel.id].standings)))
+    else:
+        await ctx.reply('В этом канале нет соревнования')
+
+
+@bot.command()
+async def top(ctx, arg='10'):
+    """
+    Shows top N players of current tournament
+    """
+    if ctx.channel.id in loading:
+        await ctx.reply(LOADING_REPLY)
+    elif ctx.channel.id in tournaments:
+        if not arg.isdigit() or int(arg) < 1:
+            await ctx.reply('Укажите число игроков')
+            return
+        count = min(int(arg), 30)
+        lines = [f'{place}. {player} - {rank}' for player, place, rank in tournaments[ctx.channel.id].get_top(count)]
+        if lines and count < int(arg):
+            lines.append('Полная таблица - !standings')
+        await ctx.reply('\n'.join(lines) if lines else 'Еще никто не играл')
     else:
         await ctx.reply('В этом канале нет соревнования')
 
 
+@bot.command()
+async def standings(ctx, arg='1'):
+    """
+    Shows a page of the current tournament standings
+    """
+    if ctx.channel.id in loading:
+        await ctx.reply(LOADING_REPLY)
+    elif ctx.channel.id in tournaments:
+        tour = tournaments[ctx.channel.id]
+        pages = tour.page_count()
+        if not arg.isdigit() or not 1 <= int(arg) <= pages:
+            await ctx.reply('Укажите номер страницы от 1 до ' + str(pages))
+            return
+        text = tour.get_standings_page(int(arg) - 1)
+        await ctx.reply(f'Страница {arg} из {pages}\n' + text if text else 'Еще никто не играл')
+    else:
+        await ctx.reply('В этом канале нет соревнования')
+
+
+@bot.command()
+async def project(ctx, days='7', sims='2000'):
+    """
+    Estimate chances to win (and reach ladder ranks) in the given number of days
+    """
+    if ctx.channel.id in loading:
+        await ctx.reply(LOADING_REPLY)
+        return
+    if ctx.channel.id not in tournaments:
+        await ctx.reply('В этом канале нет соревнования')
+        return
+    tour = tournaments[ctx.channel.id]
+    if not tour.rating_type:
+        await ctx.reply('В этом соревновании нет рейтинга')
+        return
+    if not days.isdigit() or not sims.isdigit() or not 0 < int(days) <= 60 or not 0 < int(sims) <= 20000:
+        await ctx.reply('Укажите число дней (до 60) и, по желанию, число симуляций (до 20000)')
+        return
+
+    try:
+        res = await projection.project(tour, int(days), int(sims), get_stats_loader().matrix)
+    except asyncio.TimeoutError:
+        await ctx.reply('Прогноз не успел посчитаться, попробуйте меньше дней')
+        return
+    if res is None:
+        await ctx.reply('Недостаточно сыгранных игр для прогноза')
+        return
+    lines = []
+    for player, first, goals in res[:10]:
+        line = f'{player}: 1 место - {round(100 * first)}%'
+        for goal, chance in goals.items():
+            line += f', {goal}+ - {round(100 * chance)}%'
+        lines.append(line)
+    await ctx.reply('Прогноз на ' + days + ' дн.:\n' + '\n'.join(lines))
+
+
 @bot.command()
 async def what_if(ctx, arg1, arg2):
     """
     Find out what ranks would be if player1 defeats player2
     """
-    if ctx.channel in tournaments:
-        r1, r2 = tournaments[ctx.channel].check_game(arg1, arg2)
+    if ctx.channel.id in loading:
+        await ctx.reply(LOADING_REPLY)
+    elif ctx.channel.id in tournaments:
+        r1, r2 = tournaments[ctx.channel.id].check_game(arg1, arg2)
         await ctx.reply('Будет ранг ' + r1 + ' у ' + arg1 + ' и ранг ' + r2 + ' у ' + arg2)
     else:
         await ctx.reply('В этом канале нет соревнования')
 
 
-def parse_game(message):
-    lines = message.content.split('\n')
-    if len(lines) < 4:
-        return None
-
-    match = re.match('\\s*(?P<wm><@.?[0-9]*?>)\\s*defeated\\s*(?P<lm><@.?[0-9]*?>)', lines[0].lower())
-    if match is None:
-        return None
-    winner_mention = match.group('wm')
-    loser_mention = match.group('lm')
-    if loser_mention == winner_mention:
-        return None
-    mentions = message.mentions
-    if len(mentions) != 2:
-        return None
-    winner, loser = mentions
-    if winner.mention != winner_mention:
-        winner, loser = loser, winner
-    if winner.mention != winner_mention:
-        # Should never happen but...
-        return None
-
-    heroes = lines[1].lower().split(' vs ')
-    if len(heroes) < 2:
-        return None
-
-    board = lines[2]
-
-    match = re.search('<@.?[0-9]*?>', lines[3])
-    if match is None:
-        return None
-    player1_mention = match.group()
-    winner_first = True
-    if winner_mention != player1_mention:
-        winner_first = False
-
-    return unmatched.Match(winner.name, loser.name, heroes[0], heroes[1], board, winner_first)
-
-
-def check_message(message, user):
-    match = parse_game(message)
-    if match is None:
+@bot.command()
+async def history(ctx, arg='10'):
+    """
+    Shows your last N games (or of the mentioned player) in current tournament
+    """
+    if ctx.channel.id in loading:
+        await ctx.reply(LOADING_REPLY)
+        return
+    if ctx.channel.id not in tournaments:
+        await ctx.reply('В этом канале нет соревнования')
+        return
+    count = int(arg) if arg.isdigit() else 10
+    if count < 1:
+        await ctx.reply('Укажите число игр')
+        return
+    player = ctx.message.mentions[0].name if ctx.message.mentions else ctx.author.name
+    games = tournaments[ctx.channel.id].history.last_matches(player, min(count, 30))
+    lines = []
+    for day, won, opponent, hero, opp_hero, board in games:
+        line = f'{day.strftime("%d.%m.%Y")} ' if day is not None else ''
+        line += f'{"победа над" if won else "поражение от"} {opponent}: {hero} против {opp_hero}, {board}'
+        lines.append(line)
+    await ctx.reply('\n'.join(lines) if lines else player + ' еще не играл')
+
+
+@bot.command()
+async def h2h(ctx):
+    """
+    Score of two mentioned players against each other in current tournament
+    """
+    if ctx.channel.id in loading:
+        await ctx.reply(LOADING_REPLY)
+        return
+    if ctx.channel.id not in tournaments:
+        await ctx.reply('В этом канале нет соревнования')
+        return
+    # Mentions come in no particular order, the message text has the order the players were named in
+    users = {user.id: user for user in ctx.message.mentions}
+    ids = dict.fromkeys(int(id) for id in re.findall('<@!?([0-9]+)>', ctx.message.content))
+    players = [users[id].name for id in ids if id in users]
+    if len(players) != 2:
+        await ctx.reply('Упомяните двух игроков')
+        return
+    player1, player2 = players
+    wins, losses = tournaments[ctx.channel.id].history.head_to_head(player1, player2)
+    await ctx.reply(f'{player1} против {player2}: {format_score(wins, losses)}')
+
+
+@bot.command()
+async def my_heroes(ctx):
+    """
+    Your score with your most played heroes and boards in current tournament
+    """
+    if ctx.channel.id in loading:
+        await ctx.reply(LOADING_REPLY)
+        return
+    if ctx.channel.id not in tournaments:
+        await ctx.reply('В этом канале нет соревнования')
+        return
+    tour_history = tournaments[ctx.channel.id].history
+    heroes = tour_history.hero_stats(ctx.author.name)
+    if not heroes:
+        await ctx.reply('Вы еще не играли')
+        return
+    boards = tour_history.board_stats(ctx.author.name)
+    await ctx.reply(f'Персонажи:\n{format_ranked(heroes[:MY_HEROES_TOP])}\n'
+                    f'Поля:\n{format_ranked(boards[:MY_HEROES_TOP])}')
+
+
+@bot.command()
+async def backfill(ctx, since=None):
+    """
+    Record confirmed reports missed while the bot was offline, since the given date (dd.mm.yyyy)
+    or the day of the last recorded match. Requires admin rights
+    """
+    if not state.is_admin(ctx.author.id):
+        await ctx.send('Недостаточно прав')
+        return
+    if ctx.channel.id in loading:
+        await ctx.reply(LOADING_REPLY)
+        return
+    if ctx.channel.id not in tournaments:
+        await ctx.reply('В этом канале нет соревнования')
+        return
+    tour = tournaments[ctx.channel.id]
+    from pytz import timezone
+    tz = timezone('Europe/Moscow')
+    if since is not None:
+        try:
+            after = tz.localize(datetime.strptime(since, '%d.%m.%Y'))
+        except ValueError:
+            await ctx.reply('Укажите дату в формате дд.мм.гггг')
+            return
+    elif tour.history.last_day():
+        after = tz.localize(datetime.fromordinal(tour.history.last_day()))
+    else:
+        after = None
+
+    await ctx.reply('Просматриваю историю канала')
+    scanned, found, missing = await find_unrecorded(ctx.channel, tour, after)
+    recorded = []
+    errors = []
+    # Rows and standings pile up in the write queue and go to the sheet in one batch
+    for message, match in missing:
+        try:
+            if await tour.report_match(match, message.id):
+                recorded.append(message)
+        except unmatched.UMException as err:
+            errors.append(f'{message.jump_url}: {err}')
+    for message in recorded:
+        await message.add_reaction(DRAGON)
+    METRICS.inc('backfill_matches_total', value=len(recorded), tournament=tour.name)
+    reply = f'Просмотрено сообщений - {scanned}, отчетов - {found}, восстановлено матчей - {len(recorded)}'
+    if errors:
+        reply += '\nНе удалось записать:\n' + '\n'.join(errors[:10])
+    await ctx.reply(reply)
+
+
+class Report:
+    """
+    What we need to remember about a parsed report message
+    """
+    __slots__ = ('author_id', 'author_name', 'match', 'acked')
+
+    def __init__(self, author_id, author_name, match, acked):
+        self.author_id = author_id
+        self.author_name = author_name
+        self.match = match
+        # The message already carries our dragon
+        self.acked = acked
+
+
+# message id -> Report, None for messages that are not reports
+reports = OrderedDict()
+REPORTS_CACHE_SIZE = 256
+
+
+async def get_report(channel, message_id, label):
+    if message_id in reports:
+        reports.move_to_end(message_id)
+        return reports[message_id]
+
+    message = await channel.fetch_message(message_id)
+    with METRICS.timer('reaction_stage_seconds', stage='parse', tournament=label):
+        match = parse_game(message)
+    report = None
+    if match is not None:
+        acked = any(str(reaction.emoji) == DRAGON and reaction.me for reaction in message.reactions)
+        report = Report(message.author.id, message.author.name, match, acked)
+    reports[message_id] = report
+    if len(reports) > REPORTS_CACHE_SIZE:
+        reports.popitem(last=False)
+    return report
+
+
+async def check_report(channel_id, message_id, report, user_name):
+    tour = tournaments[channel_id]
+    match = report.match
+    METRICS.inc('reactions_total', outcome='parsed', tournament=tour.name)
+    if not confirms(match, report.author_name, user_name):
+        METRICS.inc('reactions_total', outcome='rejected', tournament=tour.name)
         return False
-    name1 = message.author.name
-    name2 = user.name
-    if match.winner != name1:
-        name1, name2 = name2, name1
-    if match.winner != name1 or match.loser != name2:
+    if message_id not in tour.recorded and report.acked:
+        # Recorded before its id was journaled, or the journal was reset: the dragon is the only trace
+        tour.recorded.add(message_id)
+        METRICS.inc('reactions_total', outcome='duplicate', tournament=tour.name)
         return False
-    tournaments[message.channel].report_match(match)
+    with METRICS.timer('reaction_stage_seconds', stage='report', tournament=tour.name):
+        if not await tour.report_match(match, message_id):
+            METRICS.inc('reactions_total', outcome='duplicate', tournament=tour.name)
+            return False
+    report.acked = True
     return True
 
 
-message_locks = {}
-
-
 @bot.event
-async def on_reaction_add(reaction, user):
-    if reaction.message.channel not in tournaments:
+async def on_raw_reaction_add(payload):
+    # Everything outside tournament channels is dropped before any fetch
+    ch_id = payload.channel_id
+    if ch_id not in tournaments and ch_id not in loading:
         return
-    if user == reaction.message.author:
+    if payload.user_id == bot.user.id:
+        return
+    if ch_id in loading:
+        await loading[ch_id][1].wait()
+    if ch_id not in tournaments:
         return
 
-    m_id = reaction.message.id
-    lock = message_locks.setdefault(m_id, RLock())
-
-    with lock:
+    label = tournaments[ch_id].name
+    channel = bot.get_channel(ch_id) or await bot.fetch_channel(ch_id)
+    with METRICS.timer('reaction_seconds', tournament=label):
+        message = channel.get_partial_message(payload.message_id)
         try:
-            for r in reaction.message.reactions:
-                if r.me:
-                    return
-            if not check_message(reaction.message, user):
+            report = await get_report(channel, payload.message_id, label)
+            if report is None or payload.user_id == report.author_id:
+                return
+            user = payload.member or bot.get_user(payload.user_id) or await bot.fetch_user(payload.user_id)
+            if not await check_report(ch_id, payload.message_id, report, user.name):
                 return
-            await reaction.message.add_reaction('\U0001F409')
+            with METRICS.timer('reaction_stage_seconds', stage='ack', tournament=label):
+                await message.add_reaction(DRAGON)
+            METRICS.inc('reactions_total', outcome='recorded', tournament=label)
         except unmatched.UMException as err:
-            await reaction.message.reply("Ошибка при записи матча: " + str(err))
+            METRICS.inc('reactions_total', outcome='rejected', tournament=label)
+            # The author will likely fix the message, parse it again next time
+            reports.pop(payload.message_id, None)
+            await message.reply("Ошибка при записи матча: " + str(err))
             return
         except Exception as err:
-            await reaction.message.reply("Что-то не так, админ, посмотри логи")
+            METRICS.inc('reactions_total', outcome='errored', tournament=label)
             print(err)
+            try:
+                await message.reply("Что-то не так, админ, посмотри логи")
+            except discord.HTTPException as reply_err:
+                # The message may be gone already
+                print(reply_err)
             return
-        finally:
-            message_locks.pop(m_id, None)
 
 
 @bot.event
-async def on_ready():
-    load_tournaments()
+async def on_raw_message_edit(payload):
+    # An edited report is parsed again on the next reaction
+    reports.pop(payload.message_id, None)
 
-bot.run(settings['token'])
+
+metrics_server = None
+loop_watchdog = profiling.LoopWatchdog(settings.get('loop_block_seconds', 0.5))
+METRICS.gauge('discord_latency_seconds', lambda: bot.latency)
+
+
+@bot.event
+async def setup_hook():
+    global warm_up_task
+    loop = asyncio.get_running_loop()
+    loop_watchdog.start(loop)
+    warm_up_task = loop.run_in_executor(None, warm_up)
+
+
+@bot.event
+async def on_ready():
+    global metrics_server
+    registered = register_tournaments()
+    first = not STARTUP.finished
+    if first:
+        STARTUP.phase('gateway')
+    if 'metrics_port' in settings and metrics_server is None:
+        metrics_server = await metrics.serve(settings['metrics_port'])
+    if warm_up_task is not None:
+        try:
+            await warm_up_task
+        except Exception as err:
+            print(err)
+    if first:
+        STARTUP.phase('warm up')
+    await flush_spooled_writes()
+    get_stats_loader().start()
+    await load_tournaments(registered)
+    if first:
+        STARTUP.phase('tournaments')
+        STARTUP.finished = True
+        print(STARTUP.render())
+
+
+# Process pool workers re-import this module, they must not start the bot
+if __name__ == '__main__':
+    bot.run(settings['token'])
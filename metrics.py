@@ -0,0 +1,149 @@
+from bisect import bisect_left
+from contextlib import contextmanager
+from threading import Lock
+import asyncio
+import time
+
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+
+class Histogram:
+    def __init__(self):
+        self.counts = [0] * (len(BUCKETS) + 1)
+        self.sum = 0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect_left(BUCKETS, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def quantile(self, q):
+        """
+        Upper bound of the bucket holding the q-quantile
+        """
+        target = q * self.count
+        total = 0
+        for i, count in enumerate(self.counts):
+            total += count
+            if total >= target and count:
+                return BUCKETS[i] if i < len(BUCKETS) else float('inf')
+        return 0
+
+
+def format_labels(labels, extra=None):
+    items = list(labels) + ([extra] if extra else [])
+    if not items:
+        return ''
+    escaped = [(k, str(v).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')) for k, v in items]
+    return '{' + ','.join(f'{k}="{v}"' for k, v in escaped) + '}'
+
+
+class Registry:
+    def __init__(self):
+        self.lock = Lock()
+        self.counters = {}
+        self.histograms = {}
+        self.gauges = {}
+
+    def inc(self, name, value=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def observe(self, name, value, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            if key not in self.histograms:
+                self.histograms[key] = Histogram()
+            self.histograms[key].observe(value)
+
+    def gauge(self, name, func):
+        self.gauges[name] = func
+
+    @contextmanager
+    def timer(self, name, **labels):
+        """
+        Observe the duration of the block, labeled with status ok or error
+        """
+        start = time.perf_counter()
+        status = 'ok'
+        try:
+            yield
+        except BaseException:
+            status = 'error'
+            raise
+        finally:
+            self.observe(name, time.perf_counter() - start, status=status, **labels)
+
+    def render(self):
+        """
+        Prometheus text exposition format
+        """
+        lines = []
+        with self.lock:
+            counters = sorted(self.counters.items())
+            histograms = sorted(self.histograms.items(), key=lambda x: x[0])
+            buckets = [(key, list(h.counts), h.sum, h.count) for key, h in histograms]
+        for name, func in sorted(self.gauges.items()):
+            lines.append(f'# TYPE {name} gauge')
+            lines.append(f'{name} {func()}')
+        last = None
+        for (name, labels), value in counters:
+            if name != last:
+                lines.append(f'# TYPE {name} counter')
+                last = name
+            lines.append(f'{name}{format_labels(labels)} {value}')
+        for (name, labels), counts, total, count in buckets:
+            if name != last:
+                lines.append(f'# TYPE {name} histogram')
+                last = name
+            cumulative = 0
+            for bound, bucket in zip(BUCKETS, counts):
+                cumulative += bucket
+                lines.append(f'{name}_bucket{format_labels(labels, ("le", bound))} {cumulative}')
+            lines.append(f'{name}_bucket{format_labels(labels, ("le", "+Inf"))} {count}')
+            lines.append(f'{name}_sum{format_labels(labels)} {total}')
+            lines.append(f'{name}_count{format_labels(labels)} {count}')
+        return '\n'.join(lines) + '\n'
+
+    def summary(self):
+        """
+        Short human readable digest for the chat
+        """
+        lines = []
+        with self.lock:
+            for (name, labels), value in sorted(self.counters.items()):
+                lines.append(f'{name}{format_labels(labels)} {value}')
+            for (name, labels), h in sorted(self.histograms.items(), key=lambda x: x[0]):
+                lines.append(f'{name}{format_labels(labels)} n={h.count} avg={1000 * h.sum / h.count:.0f}ms '
+                             f'p50<={1000 * h.quantile(0.5):.0f}ms p95<={1000 * h.quantile(0.95):.0f}ms')
+        for name, func in sorted(self.gauges.items()):
+            lines.append(f'{name} {func()}')
+        return '\n'.join(lines)
+
+
+METRICS = Registry()
+
+
+async def handle_scrape(reader, writer):
+    try:
+        while True:
+            line = await reader.readline()
+            if not line or line in (b'\r\n', b'\n'):
+                break
+        body = METRICS.render().encode('utf-8')
+        writer.write(b'HTTP/1.1 200 OK\r\n'
+                     b'Content-Type: text/plain; version=0.0.4; charset=utf-8\r\n'
+                     b'Content-Length: ' + str(len(body)).encode() + b'\r\n'
+                     b'Connection: close\r\n\r\n' + body)
+        await writer.drain()
+    finally:
+        writer.close()
+
+
+async def serve(port, host='127.0.0.1'):
+    """
+    Expose the metrics for Prometheus on http://host:port/
+    """
+    return await asyncio.start_server(handle_scrape, host, port)
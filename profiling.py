@@ -0,0 +1,117 @@
+from datetime import datetime
+from threading import Thread, get_ident
+from utils import ROOT_DIR
+from metrics import METRICS
+import asyncio
+import cProfile
+import io
+import os
+import pstats
+import sys
+import time
+import traceback
+
+PROFILE_DIR = os.path.join(ROOT_DIR, 'resources/profiles')
+PROFILE_TOP = 25
+# Running task -> command it is executing, the task name alone only says which event started it
+COMMANDS = {}
+
+
+def set_command(name):
+    task = asyncio.current_task()
+    if task is not None:
+        COMMANDS[task] = name
+
+
+def clear_command():
+    COMMANDS.pop(asyncio.current_task(), None)
+
+
+def current_activity(loop):
+    """
+    Name of the task running on the loop and the command it is executing, if any.
+    Read from the watchdog thread while the loop is stuck, which is good enough for a diagnostic
+    """
+    task = asyncio.current_task(loop)
+    if task is None:
+        return 'callback', None
+    return task.get_name(), COMMANDS.get(task)
+
+
+class Profiler:
+    """
+    cProfile over the event loop thread for a fixed window, so every handler dispatched meanwhile is recorded.
+    Sheets calls made in executor threads are not included, only the time spent waiting for them
+    """
+    def __init__(self):
+        self.running = False
+
+    async def profile(self, seconds, top=PROFILE_TOP):
+        """
+        Returns the top functions by cumulative time and the path of the raw pstats dump,
+        None if another profile is running
+        """
+        if self.running:
+            return None
+        self.running = True
+        profiler = cProfile.Profile()
+        try:
+            profiler.enable()
+            await asyncio.sleep(seconds)
+        finally:
+            profiler.disable()
+            self.running = False
+
+        os.makedirs(PROFILE_DIR, exist_ok=True)
+        path = os.path.join(PROFILE_DIR, datetime.now().strftime('profile-%Y%m%d-%H%M%S.prof'))
+        profiler.dump_stats(path)
+        out = io.StringIO()
+        stats = pstats.Stats(profiler, stream=out)
+        stats.strip_dirs().sort_stats('cumulative').print_stats(top)
+        return out.getvalue(), path
+
+
+class LoopWatchdog:
+    """
+    Logs the event loop thread's stack whenever the loop doesn't get to its callbacks for longer than
+    threshold seconds, together with the task (and command) that holds it
+    """
+    def __init__(self, threshold, interval=0.1):
+        self.threshold = threshold
+        self.interval = interval
+        self.loop = None
+        self.thread_id = None
+        self.last_beat = time.monotonic()
+
+    def start(self, loop):
+        if self.loop is not None:
+            return
+        self.loop = loop
+        self.thread_id = get_ident()
+        self.last_beat = time.monotonic()
+        loop.call_soon(self.__beat)
+        Thread(target=self.__watch, name='loop-watchdog', daemon=True).start()
+
+    def __beat(self):
+        self.last_beat = time.monotonic()
+        self.loop.call_later(self.interval, self.__beat)
+
+    def __watch(self):
+        reported = None
+        while True:
+            time.sleep(self.interval)
+            beat = self.last_beat
+            blocked = time.monotonic() - beat
+            if blocked < self.threshold or beat == reported:
+                continue
+            reported = beat
+            task, command = current_activity(self.loop)
+            frame = sys._current_frames().get(self.thread_id)
+            stack = ''.join(traceback.format_stack(frame)) if frame is not None else ''
+            # Unnamed tasks would give every stall its own label
+            METRICS.inc('loop_blocked_total', task='task' if task.startswith('Task-') else task, command=command or '-')
+            print(f'Event loop blocked for {blocked:.2f}s so far by {task}' + (f' (!{command})' if command else '') +
+                  '\n' + stack)
+
+
+PROFILER = Profiler()
@@ -0,0 +1,182 @@
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime
+from rating import LadderRankType, make_rank_manager
+import asyncio
+import multiprocessing
+import os
+import random
+import time
+
+# Blend weight of the log5 prior against head-to-head results, in games
+PRIOR_GAMES = 4
+LADDER_GOALS = {'GOLD': LadderRankType.GOLD.value * 10,
+                'DIAMOND': LadderRankType.DIAMOND.value * 10}
+# Wall time a projection may take, fewer simulations are run for busy tournaments
+TIME_BUDGET_SECONDS = 3
+TIMEOUT_SECONDS = 15
+# CPU seconds per simulated game by rating type, replaced by the measured cost after every projection
+SECONDS_PER_GAME = {'ladder': 3e-6, 'elo': 3e-6, 'glicko': 25e-6}
+
+pool = None
+cache = {}
+
+
+def get_pool():
+    global pool
+    if pool is None:
+        pool = ProcessPoolExecutor(max_workers=os.cpu_count(),
+                                   mp_context=multiprocessing.get_context('spawn'))
+    return pool
+
+
+def log5(a, b):
+    return a * (1 - b) / (a * (1 - b) + b * (1 - a))
+
+
+def combine(p, q):
+    """
+    Probability with the odds of p scaled by the odds of q
+    """
+    odds = p / (1 - p) * q / (1 - q)
+    return odds / (1 + odds)
+
+
+def games_per_day(rows):
+    times = []
+    for row in rows:
+        try:
+            times.append(datetime.strptime(row[0], "%d.%m.%Y %H:%M:%S"))
+        except (ValueError, IndexError):
+            pass
+    if len(times) < 2:
+        return len(rows)
+    days = max((max(times) - min(times)).total_seconds() / 86400, 1)
+    return len(rows) / days
+
+
+def estimate(rows, players, char_index=None, hero_totals=None):
+    """
+    Pairing weights, per-pair win probabilities and hero usage estimated from the log
+    """
+    index = {p: i for i, p in enumerate(players)}
+    wins = [0] * len(players)
+    games = [0] * len(players)
+    pairs = dict()
+    usage = [dict() for _ in players]
+    for row in rows:
+        if len(row) < 3 or row[1] not in index or row[2] not in index:
+            continue
+        w, l = index[row[1]], index[row[2]]
+        wins[w] += 1
+        games[w] += 1
+        games[l] += 1
+        key = (min(w, l), max(w, l))
+        if key not in pairs:
+            pairs[key] = [0, 0]
+        pairs[key][0 if w < l else 1] += 1
+        if char_index is not None and len(row) >= 5:
+            for player, char in ((w, row[3]), (l, row[4])):
+                if char in char_index:
+                    usage[player][char_index[char]] = usage[player].get(char_index[char], 0) + 1
+
+    strength = [(wins[i] + 1) / (games[i] + 2) for i in range(len(players))]
+    pair_list = []
+    for (i, j), (i_wins, j_wins) in pairs.items():
+        prior = log5(strength[i], strength[j])
+        p = (i_wins + PRIOR_GAMES * prior) / (i_wins + j_wins + PRIOR_GAMES)
+        pair_list.append((i, j, i_wins + j_wins, p))
+
+    hero_rates = None
+    if hero_totals is not None:
+        hero_rates = [[(hero_totals[a][b] + 1) / (hero_totals[a][b] + hero_totals[b][a] + 2)
+                       for b in range(len(hero_totals))] for a in range(len(hero_totals))]
+    usage = [(list(u.keys()), list(u.values())) for u in usage]
+    return pair_list, usage, hero_rates
+
+
+def simulate(job):
+    """
+    Runs in a worker process: plays job['sims'] continuations of the tournament
+    """
+    started = time.process_time()
+    rnd = random.Random(job['seed'])
+    players = job['players']
+    pairs = job['pairs']
+    usage = job['usage']
+    hero_rates = job['hero_rates']
+    goals = job['goals']
+    weights = [pair[2] for pair in pairs]
+    first = [0] * len(players)
+    reached = {goal: [0] * len(players) for goal in goals}
+
+    for _ in range(job['sims']):
+        manager = make_rank_manager(job['rating'])
+        manager.load_state(job['rating_state'])
+        ranks = [manager.load_rank(rank) for rank in job['ranks']]
+        for i, j, _, p in rnd.choices(pairs, weights, k=job['games']):
+            if hero_rates is not None and usage[i][0] and usage[j][0]:
+                hero_i = rnd.choices(*usage[i])[0]
+                hero_j = rnd.choices(*usage[j])[0]
+                p = combine(p, hero_rates[hero_i][hero_j])
+            w, l = (i, j) if rnd.random() < p else (j, i)
+            ranks[w], ranks[l] = manager.update_rank(ranks[w], ranks[l])
+
+        numbers = [manager.to_number(rank) for rank in ranks]
+        best = max(numbers)
+        for k, number in enumerate(numbers):
+            if number == best:
+                first[k] += 1
+            for goal, threshold in goals.items():
+                if number >= threshold:
+                    reached[goal][k] += 1
+    return first, reached, time.process_time() - started
+
+
+async def project(tour, days, sims, matrix=None):
+    """
+    Probability of each player to finish first (and reach ladder goals) after the given number of days.
+    Cached until the next reported match
+    """
+    key = (tour.name, tour.cursor, days, sims)
+    if key in cache:
+        return cache[key]
+
+    rows = tour.journal.read()
+    players = list(tour.standings)
+    char_index = matrix.char_index if matrix is not None else None
+    hero_totals = matrix.totals.tolist() if matrix is not None else None
+    pairs, usage, hero_rates = estimate(rows, players, char_index, hero_totals)
+    if not pairs:
+        return None
+
+    games = round(games_per_day(rows) * days)
+    workers = os.cpu_count() or 1
+    cost = SECONDS_PER_GAME.get(tour.rating_type, SECONDS_PER_GAME['elo'])
+    sims = max(1, min(sims, int(TIME_BUDGET_SECONDS * workers / (cost * max(games, 1)))))
+    goals = LADDER_GOALS if tour.rating_type == 'ladder' else {}
+    jobs = []
+    for k in range(workers):
+        chunk = sims // workers + (1 if k < sims % workers else 0)
+        if chunk:
+            jobs.append({'seed': random.random(), 'sims': chunk, 'games': games,
+                         'players': players, 'pairs': pairs, 'usage': usage, 'hero_rates': hero_rates,
+                         'goals': goals, 'rating': tour.rating_type,
+                         'rating_state': tour.rating.dump_state(),
+                         'ranks': [tour.rating.dump_rank(tour.standings[p]) for p in players]})
+
+    loop = asyncio.get_running_loop()
+    # Jobs already running in the pool can't be stopped, a timeout only stops the wait for them
+    parts = await asyncio.wait_for(asyncio.gather(*[loop.run_in_executor(get_pool(), simulate, job) for job in jobs]),
+                                   TIMEOUT_SECONDS)
+    if games:
+        SECONDS_PER_GAME[tour.rating_type] = sum(part[2] for part in parts) / (games * sims)
+    first = [sum(part[0][k] for part in parts) / sims for k in range(len(players))]
+    reached = {goal: [sum(part[1][goal][k] for part in parts) / sims for k in range(len(players))]
+               for goal in goals}
+    res = sorted([(players[k], first[k], {goal: reached[goal][k] for goal in goals}) for k in range(len(players))],
+                 key=lambda x: (-x[1], [-v for v in x[2].values()]))
+
+    for old_key in [k for k in cache if k[0] == tour.name and k[1] != tour.cursor]:
+        del cache[old_key]
+    cache[key] = res
+    return res
@@ -1,5 +1,6 @@
 from enum import Enum
 from threading import RLock
+import math
 
 
 class EmptyRankManager:
@@ -12,6 +13,18 @@ class EmptyRankManager:
     def to_number(self, rank):
         return 0
 
+    def dump_rank(self, rank):
+        return rank
+
+    def load_rank(self, data):
+        return data
+
+    def dump_state(self):
+        return None
+
+    def load_state(self, data):
+        pass
+
 
 class CounterRankManager:
     def default_rank(self):
@@ -23,47 +36,109 @@ class CounterRankManager:
     def to_number(self, rank):
         return rank
 
+    def dump_rank(self, rank):
+        return rank
+
+    def load_rank(self, data):
+        return data
+
+    def dump_state(self):
+        return None
+
+    def load_state(self, data):
+        pass
+
 
 LadderRankType = Enum('RankType', ['BRONZE', 'SILVER', 'GOLD', 'DIAMOND', 'HERO'])
 
 
+class LadderTier:
+    """
+    Interned (type, value) pair with its number, name and neighbours precomputed
+    """
+    __slots__ = ('type', 'value', 'level', 'number', 'name', '_next', '_prev')
+
+    def __init__(self, rank_type, value):
+        self.type = rank_type
+        self.value = value
+        self.level = rank_type.value
+        self.number = rank_type.value * 10 + value
+        self.name = rank_type.name + ' ' + str(value)
+        self._next = None
+        self._prev = None
+
+    @property
+    def next(self):
+        if self._next is None:
+            if self.value == LadderRank.max_rank[self.type]:
+                self._next = ladder_tier(LadderRankType(self.type.value + 1), 0)
+            else:
+                self._next = ladder_tier(self.type, self.value + 1)
+        return self._next
+
+    @property
+    def prev(self):
+        if self._prev is None:
+            self._prev = ladder_tier(self.type, self.value - 1) if self.value != 0 else self
+        return self._prev
+
+
+LADDER_TIERS = {}
+
+
+def ladder_tier(rank_type, value):
+    key = (rank_type, value)
+    if key not in LADDER_TIERS:
+        LADDER_TIERS[key] = LadderTier(rank_type, value)
+    return LADDER_TIERS[key]
+
+
 class LadderRank:
+    """
+    Immutable ladder state of a player: tier, player id, last opponent id and streak against them
+    """
+    __slots__ = ('tier', 'id', 'last_opp', 'streak')
+
     max_rank = {LadderRankType.BRONZE: 2,
                 LadderRankType.SILVER: 3,
                 LadderRankType.GOLD: 4,
                 LadderRankType.DIAMOND: 5,
                 LadderRankType.HERO: -1}
 
-    def __init__(self, rank_type, value, id):
-        self.type = rank_type
-        self.value = value
+    def __init__(self, rank_type, value, id, last_opp=0, streak=0):
+        self.tier = ladder_tier(rank_type, value)
         self.id = id
-        self.last_opp = 0
-        self.streak = 0
+        self.last_opp = last_opp
+        self.streak = streak
+
+    @staticmethod
+    def make(tier, id, last_opp, streak):
+        res = object.__new__(LadderRank)
+        res.tier = tier
+        res.id = id
+        res.last_opp = last_opp
+        res.streak = streak
+        return res
+
+    @property
+    def type(self):
+        return self.tier.type
+
+    @property
+    def value(self):
+        return self.tier.value
 
     def __str__(self):
-        return self.type.name + ' ' + str(self.value)
+        return self.tier.name
 
     def copy(self):
-        res = LadderRank(self.type, self.value, self.id)
-        res.last_opp = self.last_opp
-        res.streak = self.streak
-        return res
+        return self
 
     def next_rank(self):
-        res = self.copy()
-        if self.value == self.max_rank[self.type]:
-            res.type = LadderRankType(self.type.value + 1)
-            res.value = 0
-        else:
-            res.value += 1
-        return res
+        return LadderRank.make(self.tier.next, self.id, self.last_opp, self.streak)
 
     def prev_rank(self):
-        res = self.copy()
-        if self.value != 0:
-            res.value -= 1
-        return res
+        return LadderRank.make(self.tier.prev, self.id, self.last_opp, self.streak)
 
 
 class LadderRankManager:
@@ -77,28 +152,305 @@ class LadderRankManager:
             return LadderRank(LadderRankType.BRONZE, 0, self.last_id)
 
     def update_rank(self, w_rank, l_rank):
-        new_w_rank = w_rank.copy()
-        new_l_rank = l_rank.copy()
+        w_streak = w_rank.streak + 1 if w_rank.last_opp == l_rank.id else 1
+        l_streak = l_rank.streak + 1 if l_rank.last_opp == w_rank.id else 1
+        w_tier = w_rank.tier
+        l_tier = l_rank.tier
 
-        if w_rank.last_opp == l_rank.id:
-            new_w_rank.streak += 1
-        else:
-            new_w_rank.streak = 1
-        new_w_rank.last_opp = l_rank.id
-        if l_rank.last_opp == w_rank.id:
-            new_l_rank.streak += 1
+        if (w_streak <= 3 or l_streak <= 3) and abs(w_tier.level - l_tier.level) <= 1:
+            w_tier = w_tier.next
+            l_tier = l_tier.prev
+
+        return LadderRank.make(w_tier, w_rank.id, l_rank.id, w_streak), \
+            LadderRank.make(l_tier, l_rank.id, w_rank.id, l_streak)
+
+    def to_number(self, rank):
+        return rank.tier.number
+
+    def dump_rank(self, rank):
+        return [rank.type.value, rank.value, rank.id, rank.last_opp, rank.streak]
+
+    def load_rank(self, data):
+        rank_type, value, id, last_opp, streak = data
+        return LadderRank(LadderRankType(rank_type), value, id, last_opp, streak)
+
+    def dump_state(self):
+        with self.lock:
+            return self.last_id
+
+    def load_state(self, data):
+        with self.lock:
+            self.last_id = data
+
+
+# NumPy is slow to import and most tournaments never need it, so it is imported by the functions that use it
+ELO_START = 1500
+ELO_K = 32
+
+
+class EloRank:
+    __slots__ = ('rating',)
+
+    def __init__(self, rating):
+        self.rating = rating
+
+    def __str__(self):
+        return str(round(self.rating))
+
+
+class EloRankManager:
+    def default_rank(self):
+        return EloRank(ELO_START)
+
+    def update_rank(self, w_rank, l_rank):
+        delta = ELO_K / (1 + 10 ** ((w_rank.rating - l_rank.rating) / 400))
+        return EloRank(w_rank.rating + delta), EloRank(l_rank.rating - delta)
+
+    def to_number(self, rank):
+        return rank.rating
+
+    def dump_rank(self, rank):
+        return rank.rating
+
+    def load_rank(self, data):
+        return EloRank(data)
+
+    def dump_state(self):
+        return None
+
+    def load_state(self, data):
+        pass
+
+
+def elo_batch(winners, losers, players):
+    """
+    Elo ratings after a whole log given as arrays of player indices.
+    Elo is sequential by nature, so this is a tight loop over plain floats rather than per-match objects
+    """
+    import numpy as np
+    ratings = [float(ELO_START)] * players
+    for w, l in zip(winners.tolist(), losers.tolist()):
+        delta = ELO_K / (1 + 10 ** ((ratings[w] - ratings[l]) / 400))
+        ratings[w] += delta
+        ratings[l] -= delta
+    return np.array(ratings)
+
+
+GLICKO_START = 1500
+GLICKO_RD = 350
+GLICKO_VOLATILITY = 0.06
+GLICKO_TAU = 0.5
+GLICKO_SCALE = 173.7178
+GLICKO_EPS = 1e-6
+
+
+def glicko_volatility(phi, sigma, v, delta):
+    """
+    Step 5 of Glicko-2 (Illinois algorithm), for arrays of players at once
+    """
+    import numpy as np
+    a = np.log(sigma ** 2)
+
+    def f(x):
+        ex = np.exp(x)
+        return ex * (delta ** 2 - phi ** 2 - v - ex) / (2 * (phi ** 2 + v + ex) ** 2) - (x - a) / GLICKO_TAU ** 2
+
+    big = delta ** 2 > phi ** 2 + v
+    A = a.copy()
+    B = np.where(big, np.log(np.maximum(delta ** 2 - phi ** 2 - v, 1e-300)), a - GLICKO_TAU)
+    for _ in range(100):
+        low = ~big & (f(B) < 0)
+        if not low.any():
+            break
+        B = np.where(low, B - GLICKO_TAU, B)
+
+    fa, fb = f(A), f(B)
+    for _ in range(100):
+        active = np.abs(B - A) > GLICKO_EPS
+        if not active.any():
+            break
+        C = A + (A - B) * fa / (fb - fa)
+        fc = f(C)
+        swap = fc * fb <= 0
+        A, fa = np.where(active & swap, B, A), np.where(active, np.where(swap, fb, fa / 2), fa)
+        B, fb = np.where(active, C, B), np.where(active, fc, fb)
+    return np.exp(A / 2)
+
+
+def glicko_period(mu, phi, sigma, player, opp, score):
+    """
+    One Glicko-2 rating period for all players. Games are listed from both sides,
+    player[k] scored score[k] against opp[k]. Ratings are on the Glicko-2 scale
+    """
+    import numpy as np
+    n = len(mu)
+    g = 1 / np.sqrt(1 + 3 * phi[opp] ** 2 / np.pi ** 2)
+    e = 1 / (1 + np.exp(-g * (mu[player] - mu[opp])))
+    v_inv = np.zeros(n)
+    np.add.at(v_inv, player, g ** 2 * e * (1 - e))
+    delta_sum = np.zeros(n)
+    np.add.at(delta_sum, player, g * (score - e))
+
+    new_mu = mu.copy()
+    new_phi = np.sqrt(phi ** 2 + sigma ** 2)
+    new_sigma = sigma.copy()
+    p = v_inv > 0
+    if p.any():
+        v = 1 / v_inv[p]
+        new_sigma[p] = glicko_volatility(phi[p], sigma[p], v, v * delta_sum[p])
+        phi_star = np.sqrt(phi[p] ** 2 + new_sigma[p] ** 2)
+        new_phi[p] = 1 / np.sqrt(1 / phi_star ** 2 + 1 / v)
+        new_mu[p] = mu[p] + new_phi[p] ** 2 * delta_sum[p]
+    return new_mu, new_phi, new_sigma
+
+
+def glicko_volatility_one(phi, sigma, v, delta):
+    """
+    Step 5 of Glicko-2 for a single player, the same iteration as glicko_volatility without arrays
+    """
+    a = math.log(sigma ** 2)
+    spread = delta ** 2 - phi ** 2 - v
+    base = phi ** 2 + v
+    tau2 = GLICKO_TAU ** 2
+    exp = math.exp
+
+    def f(x):
+        ex = exp(x)
+        return ex * (spread - ex) / (2 * (base + ex) ** 2) - (x - a) / tau2
+
+    A = a
+    if spread > 0:
+        B = math.log(spread)
+    else:
+        B = a - GLICKO_TAU
+        for _ in range(100):
+            if f(B) >= 0:
+                break
+            B -= GLICKO_TAU
+
+    fa, fb = f(A), f(B)
+    for _ in range(100):
+        if abs(B - A) <= GLICKO_EPS:
+            break
+        C = A + (A - B) * fa / (fb - fa)
+        fc = f(C)
+        if fc * fb <= 0:
+            A, fa = B, fb
         else:
-            new_l_rank.streak = 1
-        new_l_rank.last_opp = w_rank.id
+            fa /= 2
+        B, fb = C, fc
+    return math.exp(A / 2)
+
+
+def glicko_game(mu, phi, sigma, opp_mu, opp_phi, score):
+    """
+    A rating period of one game for one player, on the Glicko-2 scale
+    """
+    g = 1 / math.sqrt(1 + 3 * opp_phi ** 2 / math.pi ** 2)
+    e = 1 / (1 + math.exp(-g * (mu - opp_mu)))
+    v = 1 / (g ** 2 * e * (1 - e))
+    delta_sum = g * (score - e)
+    new_sigma = glicko_volatility_one(phi, sigma, v, v * delta_sum)
+    phi_star = math.sqrt(phi ** 2 + new_sigma ** 2)
+    new_phi = 1 / math.sqrt(1 / phi_star ** 2 + 1 / v)
+    return mu + new_phi ** 2 * delta_sum, new_phi, new_sigma
+
+
+def glicko_batch(winners, losers, periods, players):
+    """
+    Glicko-2 ratings and deviations after a whole log, games of the same period are rated together
+    """
+    import numpy as np
+    mu = np.zeros(players)
+    phi = np.full(players, GLICKO_RD / GLICKO_SCALE)
+    sigma = np.full(players, GLICKO_VOLATILITY)
+    order = np.argsort(periods, kind='stable')
+    winners, losers, periods = winners[order], losers[order], periods[order]
+    bounds = np.flatnonzero(np.diff(periods)) + 1
+    for w, l in zip(np.split(winners, bounds), np.split(losers, bounds)):
+        if len(w) == 0:
+            continue
+        mu, phi, sigma = glicko_period(mu, phi, sigma, np.concatenate([w, l]), np.concatenate([l, w]),
+                                       np.concatenate([np.ones(len(w)), np.zeros(len(l))]))
+    return GLICKO_START + GLICKO_SCALE * mu, GLICKO_SCALE * phi
+
+
+class GlickoRank:
+    __slots__ = ('rating', 'rd', 'volatility')
+
+    def __init__(self, rating, rd, volatility):
+        self.rating = rating
+        self.rd = rd
+        self.volatility = volatility
+
+    def __str__(self):
+        return str(round(self.rating)) + ' ±' + str(round(self.rd))
 
-        if new_w_rank.streak > 3 and new_l_rank.streak > 3:
-            return new_w_rank, new_l_rank
 
-        diff = abs(w_rank.type.value - l_rank.type.value)
-        if diff > 1:
-            return new_w_rank, new_l_rank
+class GlickoRankManager:
+    """
+    Glicko-2 where every game is a rating period of its own
+    """
+    def default_rank(self):
+        return GlickoRank(GLICKO_START, GLICKO_RD, GLICKO_VOLATILITY)
 
-        return new_w_rank.next_rank(), new_l_rank.prev_rank()
+    def update_rank(self, w_rank, l_rank):
+        w_mu, w_phi = (w_rank.rating - GLICKO_START) / GLICKO_SCALE, w_rank.rd / GLICKO_SCALE
+        l_mu, l_phi = (l_rank.rating - GLICKO_START) / GLICKO_SCALE, l_rank.rd / GLICKO_SCALE
+        new_w = glicko_game(w_mu, w_phi, w_rank.volatility, l_mu, l_phi, 1.0)
+        new_l = glicko_game(l_mu, l_phi, l_rank.volatility, w_mu, w_phi, 0.0)
+        return (GlickoRank(GLICKO_START + GLICKO_SCALE * new_w[0], GLICKO_SCALE * new_w[1], new_w[2]),
+                GlickoRank(GLICKO_START + GLICKO_SCALE * new_l[0], GLICKO_SCALE * new_l[1], new_l[2]))
 
     def to_number(self, rank):
-        return rank.type.value * 10 + rank.value
+        return rank.rating
+
+    def dump_rank(self, rank):
+        return [rank.rating, rank.rd, rank.volatility]
+
+    def load_rank(self, data):
+        return GlickoRank(*data)
+
+    def dump_state(self):
+        return None
+
+    def load_state(self, data):
+        pass
+
+
+def batch_ratings(games, system):
+    """
+    Ratings of all players after games given as (winner, loser, period) tuples, best first
+    """
+    import numpy as np
+    index = dict()
+    winners, losers, periods = [], [], []
+    for winner, loser, period in games:
+        winners.append(index.setdefault(winner, len(index)))
+        losers.append(index.setdefault(loser, len(index)))
+        periods.append(period)
+    names = list(index)
+    winners = np.array(winners, dtype=np.int64)
+    losers = np.array(losers, dtype=np.int64)
+    if system == 'elo':
+        ratings = elo_batch(winners, losers, len(names))
+        res = [(name, EloRank(float(ratings[i]))) for i, name in enumerate(names)]
+    elif system == 'glicko':
+        ratings, rds = glicko_batch(winners, losers, np.array(periods, dtype=np.int64), len(names))
+        res = [(name, GlickoRank(float(ratings[i]), float(rds[i]), 0)) for i, name in enumerate(names)]
+    else:
+        return None
+    return sorted(res, key=lambda x: -x[1].rating)
+
+
+RANK_MANAGERS = {"": EmptyRankManager,
+                 "counter": CounterRankManager,
+                 "ladder": LadderRankManager,
+                 "elo": EloRankManager,
+                 "glicko": GlickoRankManager}
+
+
+def make_rank_manager(rating_type):
+    if rating_type not in RANK_MANAGERS:
+        return None
+    return RANK_MANAGERS[rating_type]()
@@ -0,0 +1,97 @@
+import re
+import unmatched
+
+
+def parse_game(message):
+    lines = message.content.split('\n')
+    if len(lines) < 4:
+        return None
+
+    match = re.match('\\s*(?P<wm><@.?[0-9]*?>)\\s*defeated\\s*(?P<lm><@.?[0-9]*?>)', lines[0].lower())
+    if match is None:
+        return None
+    winner_mention = match.group('wm')
+    loser_mention = match.group('lm')
+    if loser_mention == winner_mention:
+        return None
+    mentions = message.mentions
+    if len(mentions) != 2:
+        return None
+    winner, loser = mentions
+    if winner.mention != winner_mention:
+        winner, loser = loser, winner
+    if winner.mention != winner_mention:
+        # Should never happen but...
+        return None
+
+    heroes = lines[1].lower().split(' vs ')
+    if len(heroes) < 2:
+        return None
+
+    board = lines[2]
+
+    match = re.search('<@.?[0-9]*?>', lines[3])
+    if match is None:
+        return None
+    player1_mention = match.group()
+    winner_first = True
+    if winner_mention != player1_mention:
+        winner_first = False
+
+    return unmatched.Match(winner.name, loser.name, heroes[0], heroes[1], board, winner_first)
+
+
+DRAGON = '\U0001F409'
+
+
+def confirms(match, author_name, user_name):
+    """
+    True if a reaction of user_name confirms the match reported by author_name
+    """
+    return {match.winner, match.loser} == {author_name, user_name} and author_name != user_name
+
+
+async def find_confirmation(message, match):
+    """
+    Name of a player other than the author who reacted to the report, None if there is none
+    """
+    for reaction in message.reactions:
+        async for user in reaction.users():
+            if not user.bot and user.id != message.author.id and confirms(match, message.author.name, user.name):
+                return user.name
+    return None
+
+
+async def find_unrecorded(channel, tour, after):
+    """
+    Confirmed reports in the channel since after that are missing from the tournament log, oldest first.
+    Reports are reconciled by message id, by the bot's dragon, and for rows logged without an id
+    by matching (winner, loser, heroes, board) against rows logged since the same day.
+    Returns (messages scanned, reports found, missing [(message, match)])
+    """
+    logged = tour.history.signatures(after.date().toordinal() if after is not None else 0)
+    scanned = 0
+    found = 0
+    missing = []
+    async for message in channel.history(limit=None, after=after, oldest_first=True):
+        scanned += 1
+        if message.author.bot:
+            continue
+        match = parse_game(message)
+        if match is None:
+            continue
+        found += 1
+        key = (match.winner, match.loser, match.winner_character, match.loser_character, match.board)
+        acked = any(str(reaction.emoji) == DRAGON and reaction.me for reaction in message.reactions)
+        if acked or message.id in tour.recorded:
+            if logged[key] > 0:
+                logged[key] -= 1
+            continue
+        if await find_confirmation(message, match) is None:
+            continue
+        if logged[key] > 0:
+            logged[key] -= 1
+            continue
+        match.played_at = message.created_at
+        missing.append((message, match))
+    return scanned, found, missing
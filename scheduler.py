@@ -0,0 +1,133 @@
+from concurrent.futures import ThreadPoolExecutor
+from heapq import heappush, heappop
+from metrics import METRICS
+import asyncio
+import random
+import time
+
+PRIORITY_LOG = 0
+PRIORITY_STANDINGS = 1
+PRIORITY_READ = 2
+PRIORITY_NAMES = {PRIORITY_LOG: 'log', PRIORITY_STANDINGS: 'standings', PRIORITY_READ: 'read'}
+RETRY_STATUSES = (429, 500, 502, 503, 504)
+
+
+def error_status(err):
+    resp = getattr(err, 'resp', None)
+    return getattr(resp, 'status', None)
+
+
+def is_retryable(err, idempotent=True):
+    """
+    A 429 is rejected before anything is applied, after any other failure a request may have gone through,
+    so only idempotent requests are resent
+    """
+    # Any error raised by a request means the client libraries are already imported
+    import httplib2
+    status = error_status(err)
+    if status == 429:
+        return True
+    if not idempotent:
+        return False
+    if status is not None:
+        return status in RETRY_STATUSES
+    return isinstance(err, (OSError, httplib2.HttpLib2Error))
+
+
+class SheetsScheduler:
+    """
+    Every Sheets request goes through here. Requests wait in a priority queue for a free worker
+    and a token of a bucket sized to the per-user quota, so live match writes go first and background reads
+    can't starve them. Quota and server errors are retried with exponential backoff and jitter,
+    a 429 pauses the whole bucket since the quota is shared
+    """
+    RATE_PER_MINUTE = 60
+    BURST = 10
+    # One worker is always left to log writes and standings
+    RESERVED = 1
+    MAX_ATTEMPTS = 6
+    BACKOFF_BASE = 1
+    BACKOFF_MAX = 64
+
+    def __init__(self, max_in_flight):
+        self.max_in_flight = max_in_flight
+        self.executor = ThreadPoolExecutor(max_workers=max_in_flight, thread_name_prefix='sheets')
+        self.tokens = self.BURST
+        self.refilled_at = time.monotonic()
+        self.paused_until = 0
+        self.in_flight = 0
+        self.waiting = []
+        self.seq = 0
+        self.wakeup = None
+
+    def queued(self):
+        return len(self.waiting)
+
+    async def run(self, priority, func, *args, idempotent=True):
+        loop = asyncio.get_running_loop()
+        for attempt in range(self.MAX_ATTEMPTS):
+            await self.__acquire(priority)
+            try:
+                return await loop.run_in_executor(self.executor, func, *args)
+            except Exception as err:
+                if not is_retryable(err, idempotent) or attempt == self.MAX_ATTEMPTS - 1:
+                    raise
+                delay = random.uniform(0, min(self.BACKOFF_MAX, self.BACKOFF_BASE * 2 ** attempt))
+                if error_status(err) == 429:
+                    self.paused_until = max(self.paused_until, time.monotonic() + delay)
+                METRICS.inc('sheets_retries_total', priority=PRIORITY_NAMES[priority])
+                print(err)
+            finally:
+                self.__release()
+            await asyncio.sleep(delay)
+
+    async def __acquire(self, priority):
+        future = asyncio.get_running_loop().create_future()
+        self.seq += 1
+        heappush(self.waiting, (priority, self.seq, future))
+        self.__dispatch()
+        try:
+            await future
+        except asyncio.CancelledError:
+            # A slot handed out right before cancellation goes back to the pool
+            if future.done() and not future.cancelled():
+                self.__release()
+            raise
+
+    def __release(self):
+        self.in_flight -= 1
+        self.__dispatch()
+
+    def __refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.BURST, self.tokens + (now - self.refilled_at) * self.RATE_PER_MINUTE / 60)
+        self.refilled_at = now
+        return now
+
+    def __dispatch(self):
+        while self.waiting:
+            priority, _, future = self.waiting[0]
+            if future.cancelled():
+                heappop(self.waiting)
+                continue
+            limit = self.max_in_flight if priority < PRIORITY_READ else self.max_in_flight - self.RESERVED
+            if self.in_flight >= limit:
+                return
+            now = self.__refill()
+            wait = max(self.paused_until - now, (1 - self.tokens) * 60 / self.RATE_PER_MINUTE)
+            if wait > 0:
+                self.__wake_later(wait)
+                return
+            heappop(self.waiting)
+            self.tokens -= 1
+            self.in_flight += 1
+            future.set_result(None)
+
+    def __wake_later(self, delay):
+        if self.wakeup is not None:
+            return
+        self.wakeup = asyncio.get_running_loop().call_later(delay, self.__on_wakeup)
+
+    def __on_wakeup(self):
+        self.wakeup = None
+        self.__dispatch()
@@ -1,68 +1,375 @@
-from google.oauth2.service_account import Credentials
-from googleapiclient.discovery import build
-from threading import RLock
+from threading import RLock, local
 from datetime import datetime
-from pytz import timezone
-from utils import ROOT_DIR
+from utils import ROOT_DIR, try_lock
+from metrics import METRICS
+from scheduler import SheetsScheduler, PRIORITY_LOG, PRIORITY_STANDINGS, PRIORITY_READ
+import asyncio
+import json
 import os
+import shutil
+
+# Caps the number of Sheets requests in flight across the whole bot
+SHEETS_MAX_IN_FLIGHT = 4
+SHEETS = SheetsScheduler(SHEETS_MAX_IN_FLIGHT)
+METRICS.gauge('sheets_queued_requests', SHEETS.queued)
+SCOPES = ['https://www.googleapis.com/auth/spreadsheets']
+SPOOL_DIR = os.path.join(ROOT_DIR, 'resources/spool')
+# Spool directory of this process and the lock that tells other processes it is alive
+PROCESS_SPOOL = None
+PROCESS_SPOOL_LOCK = None
+HTTP_TIMEOUT_SECONDS = 60
+CREDENTIALS = None
+CREDENTIALS_LOCK = RLock()
+SERVICES = local()
+
+
+def execute(request, call, label):
+    with METRICS.timer('sheets_call_seconds', call=call, tournament=label):
+        return request.execute()
+
+
+def sheet_row(row):
+    # Sheets returns every cell as a string and drops trailing empty ones
+    row = [str(value) for value in row]
+    while row and row[-1] == '':
+        row.pop()
+    return row
+
+
+def process_spool_dir():
+    """
+    Every process spools to a directory of its own, so shard processes sharing a spreadsheet
+    never touch each other's pending writes
+    """
+    global PROCESS_SPOOL, PROCESS_SPOOL_LOCK
+    if PROCESS_SPOOL is None:
+        path = os.path.join(SPOOL_DIR, str(os.getpid()))
+        lock_path = os.path.join(path, 'lock')
+        # Another process may be clearing a dead directory of the same name right now
+        while PROCESS_SPOOL_LOCK is None or not os.path.isfile(lock_path):
+            if PROCESS_SPOOL_LOCK is not None:
+                PROCESS_SPOOL_LOCK.close()
+            os.makedirs(path, exist_ok=True)
+            PROCESS_SPOOL_LOCK = try_lock(lock_path)
+        PROCESS_SPOOL = path
+    return PROCESS_SPOOL
+
+
+def load_credentials():
+    """
+    Service account credentials shared by the whole process, so the access token is refreshed once for everyone
+    """
+    global CREDENTIALS
+    with CREDENTIALS_LOCK:
+        if CREDENTIALS is None:
+            from google.oauth2.service_account import Credentials
+            cred_path = os.path.join(ROOT_DIR, 'resources/bot-key.json')
+            CREDENTIALS = Credentials.from_service_account_file(cred_path, scopes=SCOPES)
+        return CREDENTIALS
+
+
+def get_service():
+    """
+    Sheets service of the calling thread. httplib2 connections can't be shared between threads,
+    so every executor thread builds one service from the bundled discovery document and keeps its connections alive.
+    The Google client libraries take a while to import, so they are loaded on first use rather than at startup
+    """
+    service = getattr(SERVICES, 'service', None)
+    if service is None:
+        from google_auth_httplib2 import AuthorizedHttp
+        from googleapiclient.discovery import build
+        import httplib2
+        http = AuthorizedHttp(load_credentials(), http=httplib2.Http(timeout=HTTP_TIMEOUT_SECONDS))
+        service = build('sheets', 'v4', http=http, static_discovery=True, cache_discovery=False)
+        SERVICES.service = service
+    return service
+
+
+class SheetWriteQueue:
+    """
+    Write-behind queue for a single spreadsheet. Log rows are coalesced into one append per sheet,
+    standings keep only the latest snapshot. Everything pending is spooled to disk until written.
+    An append that failed may still have been applied, so before it is sent again
+    the end of the sheet is read and the rows already there are dropped
+    """
+    DEBOUNCE_SECONDS = 3
+    RETRY_SECONDS = 30
+
+    def __init__(self, spreadsheet_id):
+        self.spreadsheet_id = spreadsheet_id
+        self.spool_path = os.path.join(process_spool_dir(), spreadsheet_id + '.json')
+        self.rows = {}
+        self.standings = {}
+        # Log ranges whose last append may have been applied without us knowing
+        self.unsure = set()
+        self.labels = {}
+        self.flush_lock = asyncio.Lock()
+        self.flush_handle = None
+        if os.path.isfile(self.spool_path):
+            with open(self.spool_path, 'r', encoding='utf-8') as fin:
+                data = json.load(fin)
+            self.rows = data['rows']
+            self.standings = data['standings']
+            self.unsure = set(data.get('unsure', []))
+
+    def pending(self):
+        return bool(self.rows or self.standings)
+
+    def adopt(self, path):
+        """
+        Take over writes left in a spool file of a process that is gone, they go before our own
+        """
+        with open(path, 'r', encoding='utf-8') as fin:
+            data = json.load(fin)
+        for log_range, rows in data['rows'].items():
+            self.rows[log_range] = rows + self.rows.get(log_range, [])
+        for standings_range, values in data['standings'].items():
+            self.standings.setdefault(standings_range, values)
+        self.unsure.update(data.get('unsure', []))
+        self.__dump_spool()
+        os.remove(path)
+
+    def append_row(self, log_range, row, label=None):
+        self.labels[log_range] = label or log_range
+        rows = self.rows.setdefault(log_range, [])
+        rows.append(row)
+        try:
+            self.__dump_spool()
+        except OSError:
+            # The caller treats the match as not recorded, so the row must not be written later either
+            rows.pop()
+            if not rows:
+                del self.rows[log_range]
+            raise
+        self.__schedule(self.DEBOUNCE_SECONDS)
+
+    def set_standings(self, standings_range, values, label=None):
+        self.labels[standings_range] = label or standings_range
+        self.standings[standings_range] = values
+        self.__dump_spool()
+        self.__schedule(self.DEBOUNCE_SECONDS)
+
+    async def flush(self):
+        async with self.flush_lock:
+            for log_range in list(self.rows):
+                written = list(self.rows[log_range])
+                landed = 0
+                if log_range in self.unsure:
+                    landed = await SHEETS.run(PRIORITY_LOG, self.__landed, log_range, written)
+                if landed < len(written):
+                    # Stays marked if we die or fail before the response, then the sheet is checked first
+                    self.unsure.add(log_range)
+                    self.__dump_spool()
+                    await SHEETS.run(PRIORITY_LOG, self.__append, log_range, written[landed:], idempotent=False)
+                self.unsure.discard(log_range)
+                left = self.rows[log_range][len(written):]
+                if left:
+                    self.rows[log_range] = left
+                else:
+                    del self.rows[log_range]
+                self.__dump_spool()
+
+            if self.standings:
+                written = dict(self.standings)
+                await SHEETS.run(PRIORITY_STANDINGS, self.__batch_update, written)
+                for standings_range, values in written.items():
+                    if self.standings.get(standings_range) is values:
+                        del self.standings[standings_range]
+                self.__dump_spool()
+
+    def __schedule(self, delay):
+        if self.flush_handle is not None:
+            return
+        loop = asyncio.get_running_loop()
+        self.flush_handle = loop.call_later(delay, self.__start_flush)
+
+    def __start_flush(self):
+        self.flush_handle = None
+        asyncio.ensure_future(self.__background_flush())
+
+    async def __background_flush(self):
+        try:
+            await self.flush()
+        except Exception as err:
+            print(err)
+            self.__schedule(self.RETRY_SECONDS)
+
+    def __dump_spool(self):
+        if not self.pending():
+            if os.path.isfile(self.spool_path):
+                os.remove(self.spool_path)
+            return
+        tmp_path = self.spool_path + '.tmp'
+        with open(tmp_path, 'w', encoding='utf-8') as fout:
+            json.dump({'rows': self.rows, 'standings': self.standings, 'unsure': sorted(self.unsure)},
+                      fout, ensure_ascii=False)
+            fout.flush()
+            os.fsync(fout.fileno())
+        os.replace(tmp_path, self.spool_path)
+
+    def __append(self, log_range, rows):
+        service = get_service()
+        body = {'values': rows}
+        request = service.spreadsheets().values().append(spreadsheetId=self.spreadsheet_id, range=log_range,
+                                                         valueInputOption="RAW", body=body)
+        execute(request, 'append', self.labels.get(log_range, log_range))
+
+    def __landed(self, log_range, rows):
+        """
+        Number of leading rows that are already the last rows of the sheet
+        """
+        service = get_service()
+        request = service.spreadsheets().values().get(spreadsheetId=self.spreadsheet_id, range=log_range)
+        values = execute(request, 'get', self.labels.get(log_range, log_range)).get('values', [])
+        tail = [sheet_row(row) for row in values[-len(rows):]]
+        rows = [sheet_row(row) for row in rows]
+        for count in range(len(rows), 0, -1):
+            if tail[len(tail) - count:] == rows[:count]:
+                return count
+        return 0
+
+    def __batch_update(self, standings):
+        service = get_service()
+        body = {'valueInputOption': 'RAW',
+                'data': [{'range': r, 'values': values} for r, values in standings.items()]}
+        request = service.spreadsheets().values().batchUpdate(spreadsheetId=self.spreadsheet_id, body=body)
+        execute(request, 'batchUpdate', ','.join(sorted(self.labels.get(r, r) for r in standings)))
+
+
+WRITE_QUEUES = {}
+
+
+def get_write_queue(spreadsheet_id):
+    if spreadsheet_id not in WRITE_QUEUES:
+        WRITE_QUEUES[spreadsheet_id] = SheetWriteQueue(spreadsheet_id)
+    return WRITE_QUEUES[spreadsheet_id]
+
+
+def adopt_spool(path):
+    for file in os.listdir(path):
+        if file.endswith('.json'):
+            get_write_queue(file[:-len('.json')]).adopt(os.path.join(path, file))
+
+
+async def flush_spooled_writes():
+    """
+    Flush writes left in the spool by previous runs. Spools of processes that are still alive are left alone
+    """
+    own = process_spool_dir()
+    # One process at a time adopts spools, so an orphaned file is never taken twice
+    adopt_lock = None
+    while adopt_lock is None:
+        adopt_lock = try_lock(os.path.join(SPOOL_DIR, 'adopt.lock'))
+        if adopt_lock is None:
+            await asyncio.sleep(0.1)
+    try:
+        for name in os.listdir(SPOOL_DIR):
+            path = os.path.join(SPOOL_DIR, name)
+            if path == own or not os.path.isdir(path):
+                continue
+            lock = try_lock(os.path.join(path, 'lock'))
+            if lock is None:
+                continue
+            adopt_spool(path)
+            shutil.rmtree(path)
+            lock.close()
+        # Files directly in the spool directory come from versions without per-process spools, they are the oldest
+        adopt_spool(SPOOL_DIR)
+    finally:
+        adopt_lock.close()
+
+    for queue in list(WRITE_QUEUES.values()):
+        if not queue.pending():
+            continue
+        try:
+            await queue.flush()
+        except Exception as err:
+            print(err)
+
+
+def load_logs(spreadsheet_id, sheets, starts=None):
+    """
+    Raw log rows of several sheets of one spreadsheet, fetched in a single batchGet.
+    If given, starts[i] is the number of leading rows to skip in sheets[i]
+    """
+    service = get_service()
+    if starts is None:
+        ranges = [sheet + SpreadsheetGameLogger.LOG_CELLS for sheet in sheets]
+    else:
+        ranges = [sheet + '!A' + str(start + 2) + ':H' for sheet, start in zip(sheets, starts)]
+    request = service.spreadsheets().values().batchGet(spreadsheetId=spreadsheet_id, ranges=ranges)
+    response = execute(request, 'batchGet', 'stats')
+    return [value_range.get('values', []) for value_range in response.get('valueRanges', [])]
+
+
+async def load_logs_async(spreadsheet_id, sheets, starts=None):
+    return await SHEETS.run(PRIORITY_READ, load_logs, spreadsheet_id, sheets, starts)
 
 
 class SpreadsheetGameLogger:
-    SCOPES = ['https://www.googleapis.com/auth/spreadsheets']
+    SCOPES = SCOPES
     LOG_CELLS = '!A2:H'
     STANDINGS_CELLS = '!A2:B'
 
-    def __init__(self, spreadsheet_id, log_name, standings_name):
+    def __init__(self, spreadsheet_id, log_name, standings_name, label=None):
         self.spreadsheet_id = spreadsheet_id
-        self.log_range = log_name + self.LOG_CELLS
+        self.label = label or log_name or standings_name
+        self.log_name = log_name
+        self.log_range = log_name + self.LOG_CELLS if log_name is not None else None
         self.use_standings = False
         if standings_name is not None:
             self.use_standings = True
             self.standings_range = standings_name + self.STANDINGS_CELLS
-        cred_path = os.path.join(ROOT_DIR, 'resources/bot-key.json')
-        self.creds = Credentials.from_service_account_file(cred_path, scopes=self.SCOPES)
-        self.lock = RLock()
-
-    def log_match(self, match, is_rated):
-        with self.lock:
-            service = build('sheets', 'v4', credentials=self.creds)
-
-            tz = timezone('Europe/Moscow')
-            values = [[datetime.now(tz).strftime("%d.%m.%Y %H:%M:%S"),
-                       match.winner,
-                       match.loser,
-                       match.winner_character,
-                       match.loser_character,
-                       match.board,
-                       "Победитель" if match.winner_first else "Проигравший",
-                       "+" if is_rated else "-"]]
-            body = {'values': values}
-
-            sheet = service.spreadsheets()
-            sheet.values().append(spreadsheetId=self.spreadsheet_id, range=self.log_range,
-                                  valueInputOption="RAW", body=body).execute()
-
-    def update_standings(self, standings):
+        # One request per logger at a time, so a busy tournament can't occupy every executor worker
+        self.async_lock = asyncio.Lock()
+
+    async def __run(self, func, *args):
+        async with self.async_lock:
+            return await SHEETS.run(PRIORITY_READ, func, *args)
+
+    def __queue(self):
+        return get_write_queue(self.spreadsheet_id)
+
+    async def log_match_async(self, match, is_rated):
+        row = self.make_row(match, is_rated)
+        self.__queue().append_row(self.log_range, row, self.label)
+        return row
+
+    async def update_standings_async(self, standings):
         if not self.use_standings:
             return
-        with self.lock:
-            service = build('sheets', 'v4', credentials=self.creds)
+        self.__queue().set_standings(self.standings_range, self.make_standings(standings), self.label)
 
-            values = [[name, str(rank)] for name, rank in standings]
-            body = {'values': values}
+    async def load_log_async(self, start=0):
+        # Rows still waiting in the write queue must be on the sheet before it is read
+        await self.__queue().flush()
+        return await self.__run(self.load_log, start)
 
-            sheet = service.spreadsheets()
-            sheet.values().update(spreadsheetId=self.spreadsheet_id, range=self.standings_range,
-                                  valueInputOption="RAW", body=body).execute()
+    @staticmethod
+    def make_row(match, is_rated):
+        from pytz import timezone
+        tz = timezone('Europe/Moscow')
+        played_at = match.played_at.astimezone(tz) if match.played_at is not None else datetime.now(tz)
+        return [played_at.strftime("%d.%m.%Y %H:%M:%S"),
+                match.winner,
+                match.loser,
+                match.winner_character,
+                match.loser_character,
+                match.board,
+                "Победитель" if match.winner_first else "Проигравший",
+                "+" if is_rated else "-"]
 
-    def load_results(self, get_stats=False):
-        service = build('sheets', 'v4', credentials=self.creds)
+    @staticmethod
+    def make_standings(standings):
+        return [[name, str(rank)] for name, rank in standings]
 
-        sheet = service.spreadsheets()
-        response = sheet.values().get(spreadsheetId=self.spreadsheet_id, range=self.log_range).execute()
-        rows = response.get('values', [])
+    def load_log(self, start=0):
+        """
+        Raw log rows, skipping the first start rows
+        """
+        service = get_service()
 
-        if not get_stats:
-            return [[r[1], r[2]] for r in rows]
-        else:
-            return [[r[3], r[4]] for r in rows]
+        log_range = self.log_name + '!A' + str(start + 2) + ':H'
+        sheet = service.spreadsheets()
+        response = execute(sheet.values().get(spreadsheetId=self.spreadsheet_id, range=log_range), 'get', self.label)
+        return response.get('values', [])
@@ -0,0 +1,126 @@
+from spreadsheets import SpreadsheetGameLogger
+from threading import RLock
+import asyncio
+import sqlite3
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS matches (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    tournament TEXT NOT NULL,
+    played_at TEXT NOT NULL,
+    winner TEXT NOT NULL,
+    loser TEXT NOT NULL,
+    winner_character TEXT NOT NULL,
+    loser_character TEXT NOT NULL,
+    board TEXT NOT NULL,
+    first TEXT NOT NULL,
+    rated TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS matches_by_tournament ON matches (tournament, id);
+CREATE INDEX IF NOT EXISTS matches_by_winner ON matches (tournament, winner);
+CREATE INDEX IF NOT EXISTS matches_by_loser ON matches (tournament, loser);
+CREATE TABLE IF NOT EXISTS standings (
+    tournament TEXT NOT NULL,
+    position INTEGER NOT NULL,
+    player TEXT NOT NULL,
+    rank TEXT NOT NULL,
+    PRIMARY KEY (tournament, position)
+);
+'''
+COLUMNS = 'played_at, winner, loser, winner_character, loser_character, board, first, rated'
+
+
+class SqliteGameLogger:
+    """
+    Game log kept in a local SQLite database, rows have the same layout as the log sheet.
+    Standings can optionally be mirrored to a spreadsheet for the public
+    """
+    def __init__(self, db_path, tournament, mirror=None, source=None):
+        self.tournament = tournament
+        self.mirror = mirror
+        self.source = source
+        self.lock = RLock()
+        # position -> (player, rank) as stored, so only changed rows are written
+        self.stored = None
+        self.db = sqlite3.connect(db_path, check_same_thread=False)
+        self.db.execute('PRAGMA journal_mode=WAL')
+        self.db.execute('PRAGMA synchronous=NORMAL')
+        self.db.executescript(SCHEMA)
+
+    @staticmethod
+    async def __run(func, *args):
+        # Commits wait for the disk, they must not hold up the event loop
+        return await asyncio.get_running_loop().run_in_executor(None, func, *args)
+
+    async def log_match_async(self, match, is_rated):
+        return await self.__run(self.log_match, match, is_rated)
+
+    async def update_standings_async(self, standings):
+        await self.__run(self.update_standings, standings)
+        if self.mirror is not None:
+            await self.mirror.update_standings_async(standings)
+
+    async def load_log_async(self, start=0):
+        # A new tournament can be seeded from an existing log sheet
+        if self.source is not None and start == 0 and await self.__run(self.count) == 0:
+            await self.__run(self.bulk_load, await self.source.load_log_async())
+        return await self.__run(self.load_log, start)
+
+    async def load_results_async(self, get_stats=False):
+        return await self.__run(self.load_results, get_stats)
+
+    def log_match(self, match, is_rated):
+        row = SpreadsheetGameLogger.make_row(match, is_rated)
+        self.bulk_load([row])
+        return row
+
+    def bulk_load(self, rows):
+        # Sheet rows may miss trailing empty cells
+        rows = [[self.tournament] + (list(row) + [''] * 8)[:8] for row in rows]
+        with self.lock, self.db:
+            self.db.executemany('INSERT INTO matches (tournament, ' + COLUMNS + ') VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                                rows)
+
+    def update_standings(self, standings):
+        """
+        Writes only the positions whose player or rank changed, a match usually moves a few lines
+        """
+        values = SpreadsheetGameLogger.make_standings(standings)
+        with self.lock:
+            if self.stored is None:
+                cursor = self.db.execute('SELECT position, player, rank FROM standings WHERE tournament = ?',
+                                         (self.tournament,))
+                self.stored = {position: (player, rank) for position, player, rank in cursor}
+            changed = [(self.tournament, i + 1, name, rank) for i, (name, rank) in enumerate(values)
+                       if self.stored.get(i + 1) != (name, rank)]
+            try:
+                with self.db:
+                    self.db.executemany('INSERT OR REPLACE INTO standings (tournament, position, player, rank) '
+                                        'VALUES (?, ?, ?, ?)', changed)
+                    self.db.execute('DELETE FROM standings WHERE tournament = ? AND position > ?',
+                                    (self.tournament, len(values)))
+            except sqlite3.Error:
+                # The table may hold some of the rows, read it again next time
+                self.stored = None
+                raise
+            for _, position, name, rank in changed:
+                self.stored[position] = (name, rank)
+            for position in [p for p in self.stored if p > len(values)]:
+                del self.stored[position]
+
+    def count(self):
+        with self.lock:
+            return self.db.execute('SELECT COUNT(*) FROM matches WHERE tournament = ?',
+                                   (self.tournament,)).fetchone()[0]
+
+    def load_log(self, start=0):
+        with self.lock:
+            cursor = self.db.execute('SELECT ' + COLUMNS + ' FROM matches WHERE tournament = ? '
+                                     'ORDER BY id LIMIT -1 OFFSET ?', (self.tournament, start))
+            return [list(row) for row in cursor]
+
+    def load_results(self, get_stats=False):
+        if not get_stats:
+            return [[r[1], r[2]] for r in self.load_log()]
+        else:
+            return [[r[3], r[4]] for r in self.load_log()]
@@ -0,0 +1,65 @@
+from bisect import bisect_left
+
+
+class StandingsIndex:
+    """
+    Players ordered by numeric rank, best first. Players with equal ranks keep the order they joined in,
+    same as a stable sort of the standings dict
+    """
+    def __init__(self):
+        self.keys = []
+        self.player_keys = {}
+
+    def __len__(self):
+        return len(self.keys)
+
+    def update(self, player, number):
+        """
+        Returns the range of positions whose player or place may have changed
+        """
+        old_key = self.player_keys.get(player)
+        if old_key is not None:
+            old = bisect_left(self.keys, old_key)
+            if old_key[0] == -number:
+                return old, old
+            del self.keys[old]
+            seq = old_key[1]
+        else:
+            old = None
+            seq = len(self.player_keys)
+        key = (-number, seq, player)
+        new = bisect_left(self.keys, key)
+        self.keys.insert(new, key)
+        self.player_keys[player] = key
+
+        if old is None:
+            return new, len(self.keys) - 1
+        lo, hi = min(old, new), max(old, new)
+        # Places are shared by equal ranks, so a group right after the range may have shifted too
+        while hi + 1 < len(self.keys) and self.keys[hi + 1][0] in (self.keys[hi][0], old_key[0]):
+            hi += 1
+        return lo, hi
+
+    def position(self, player):
+        """
+        1-based place of a player, players with equal ranks share a place
+        """
+        key = self.player_keys.get(player)
+        if key is None:
+            return None
+        return bisect_left(self.keys, (key[0],)) + 1
+
+    def top(self, count):
+        return [key[2] for key in self.keys[:count]]
+
+    def page(self, start, count):
+        return [key[2] for key in self.keys[start:start + count]]
+
+    def players(self):
+        return [key[2] for key in self.keys]
+
+    def leaders(self):
+        if not self.keys:
+            return []
+        best = self.keys[0][0]
+        return [key[2] for key in self.keys[:bisect_left(self.keys, (best, float('inf')))]]
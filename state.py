@@ -1,24 +1,111 @@
 import json
 import os
+import sqlite3
+from threading import RLock
 from utils import ROOT_DIR
 
 STATE_FILE = os.path.join(ROOT_DIR, 'resources/state.json')
+STATE_DB = os.path.join(ROOT_DIR, 'resources/state.db')
 
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS tournaments (
+    channel_id INTEGER PRIMARY KEY,
+    guild_id INTEGER,
+    name TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS admins (
+    user_id INTEGER PRIMARY KEY
+);
+CREATE TABLE IF NOT EXISTS secrets (
+    id INTEGER PRIMARY KEY CHECK (id = 0),
+    secret TEXT NOT NULL
+);
+'''
 
-def dump_state(tournaments):
-    data = []
-    for channel in tournaments:
-        tour = tournaments[channel]
-        data.append((channel.id, tour.name))
-    with open(STATE_FILE, 'w') as fstate:
-        json.dump(data, fstate)
+# State shared by every shard process on the host. SQLite takes care of locking and atomic updates
+lock = RLock()
+db = None
 
 
-def load_state():
-    data = []
+def connect():
+    global db
+    with lock:
+        if db is None:
+            db = sqlite3.connect(STATE_DB, timeout=30, check_same_thread=False)
+            db.execute('PRAGMA journal_mode=WAL')
+            with db:
+                db.executescript(SCHEMA)
+                # user_version marks the state.json import as done, so it never runs again
+                if db.execute('PRAGMA user_version').fetchone()[0] == 0:
+                    if db.execute('SELECT COUNT(*) FROM tournaments').fetchone()[0] == 0:
+                        import_json_state(db)
+                    db.execute('PRAGMA user_version = 1')
+        return db
+
+
+def import_json_state(conn):
+    """
+    One-time migration from the old state.json, guilds are unknown there
+    """
     try:
         with open(STATE_FILE, 'r') as fstate:
             data = json.load(fstate)
-    except:
-        pass
-    return data
+    except (OSError, ValueError):
+        return
+    conn.executemany('INSERT OR IGNORE INTO tournaments (channel_id, guild_id, name) VALUES (?, NULL, ?)', data)
+
+
+def shard_of(guild_id, shard_count):
+    return (guild_id >> 22) % shard_count
+
+
+def add_tournament(channel_id, guild_id, name):
+    conn = connect()
+    with lock, conn:
+        conn.execute('INSERT OR REPLACE INTO tournaments (channel_id, guild_id, name) VALUES (?, ?, ?)',
+                     (channel_id, guild_id, name))
+
+
+def remove_tournament(channel_id):
+    conn = connect()
+    with lock, conn:
+        conn.execute('DELETE FROM tournaments WHERE channel_id = ?', (channel_id,))
+
+
+def load_state(shard_ids=None, shard_count=None):
+    """
+    (channel_id, name) of saved tournaments owned by the given shards, all of them if not sharded.
+    Tournaments with an unknown guild are returned to everyone, only the owner will find the channel
+    """
+    conn = connect()
+    with lock:
+        rows = conn.execute('SELECT channel_id, guild_id, name FROM tournaments').fetchall()
+    if not shard_count or shard_ids is None:
+        return [(ch_id, name) for ch_id, _, name in rows]
+    return [(ch_id, name) for ch_id, guild_id, name in rows
+            if guild_id is None or shard_of(guild_id, shard_count) in shard_ids]
+
+
+def add_admin(user_id):
+    conn = connect()
+    with lock, conn:
+        conn.execute('INSERT OR IGNORE INTO admins (user_id) VALUES (?)', (user_id,))
+
+
+def is_admin(user_id):
+    conn = connect()
+    with lock:
+        return conn.execute('SELECT 1 FROM admins WHERE user_id = ?', (user_id,)).fetchone() is not None
+
+
+def set_secret(secret):
+    conn = connect()
+    with lock, conn:
+        conn.execute('INSERT OR REPLACE INTO secrets (id, secret) VALUES (0, ?)', (secret,))
+
+
+def get_secret():
+    conn = connect()
+    with lock:
+        row = conn.execute('SELECT secret FROM secrets WHERE id = 0').fetchone()
+    return row[0] if row else ''
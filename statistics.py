@@ -1,47 +1,323 @@
-from spreadsheets import SpreadsheetGameLogger
-from utils import ROOT_DIR
+from spreadsheets import load_logs_async
+from utils import ROOT_DIR, try_lock
+from rating import batch_ratings
+from history import row_day
+import unmatched
+import numpy as np
+import asyncio
 import json
 import os
+import time
 import csv
 from datetime import datetime
 
 
+class SheetStats:
+    """
+    Partial (winner, loser, board) counters of one sheet, its (winner, loser, day) game sequence
+    and the number of rows they cover
+    """
+    def __init__(self, rows=0, last=None, stats=None, games=None):
+        self.rows = rows
+        self.last = last
+        self.stats = stats if stats is not None else dict()
+        self.games = games if games is not None else []
+
+    def add_rows(self, rows):
+        day = self.games[-1][2] if self.games else 0
+        for row in rows:
+            if len(row) >= 5:
+                key = (row[3], row[4], row[5] if len(row) > 5 else '')
+                self.stats[key] = self.stats.get(key, 0) + 1
+            if len(row) >= 3 and row[1] and row[2]:
+                day = row_day(row, day)
+                self.games.append([row[1], row[2], day])
+        if rows:
+            self.rows += len(rows)
+            self.last = rows[-1]
+
+    def dump(self):
+        return {'rows': self.rows, 'last': self.last,
+                'stats': [[key[0], key[1], key[2], count] for key, count in self.stats.items()],
+                'games': self.games}
+
+    @staticmethod
+    def load(data):
+        stats = {(w, l, board): count for w, l, board, count in data['stats']}
+        return SheetStats(data['rows'], data['last'], stats, data['games'])
+
+
+class MatchupMatrix:
+    """
+    Dense win counts indexed by roster position: wins[i, j, b] is how many times character i
+    defeated character j on board b. The extra last board slot collects unknown boards
+    """
+    MIN_GAMES = 3
+    TOP = 5
+
+    def __init__(self, roster, parts):
+        self.characters = [x["name"] for x in roster.characters]
+        self.boards = [x["name"] for x in roster.boards]
+        self.char_index = {name: i for i, name in enumerate(self.characters)}
+        self.board_index = {name: i for i, name in enumerate(self.boards)}
+        n, m = len(self.characters), len(self.boards)
+
+        chars = dict()
+        boards = dict()
+        self.wins = np.zeros((n, n, m + 1), dtype=np.int32)
+        for part in parts:
+            for (winner, loser, board), count in part.stats.items():
+                if not winner.strip() or not loser.strip():
+                    continue
+                if winner not in chars:
+                    chars[winner] = self.char_index[roster.parse_character(winner)]
+                if loser not in chars:
+                    chars[loser] = self.char_index[roster.parse_character(loser)]
+                if board not in boards:
+                    boards[board] = self.board_index[roster.parse_board(board)] if board.strip() else m
+                self.wins[chars[winner], chars[loser], boards[board]] += count
+
+        self.totals = self.wins.sum(axis=2)
+        self.board_wins = self.wins.sum(axis=1)
+        self.board_losses = self.wins.sum(axis=0)
+
+    def matchup(self, char1, char2):
+        i, j = self.char_index[char1], self.char_index[char2]
+        return int(self.totals[i, j]), int(self.totals[j, i])
+
+    def __ranked(self, names, wins, losses):
+        games = wins + losses
+        with np.errstate(divide='ignore', invalid='ignore'):
+            rates = wins / games
+        order = [k for k in np.argsort(-rates, kind='stable') if games[k] >= self.MIN_GAMES]
+        best = [(names[k], int(wins[k]), int(losses[k])) for k in order[:self.TOP]]
+        worst = [(names[k], int(wins[k]), int(losses[k])) for k in order[::-1][:self.TOP]]
+        return best, worst
+
+    def hero_stats(self, char):
+        """
+        Total score of a character and its best and worst matchups
+        """
+        i = self.char_index[char]
+        wins, losses = self.totals[i, :], self.totals[:, i]
+        best, worst = self.__ranked(self.characters, wins, losses)
+        return int(wins.sum()), int(losses.sum()), best, worst
+
+    def board_stats(self, board):
+        """
+        Number of games on a board and the characters doing best and worst there
+        """
+        b = self.board_index[board]
+        wins, losses = self.board_wins[:, b], self.board_losses[:, b]
+        best, worst = self.__ranked(self.characters, wins, losses)
+        return int(wins.sum()), best, worst
+
+    def export_winrates(self, path):
+        games = self.totals + self.totals.T
+        with np.errstate(divide='ignore', invalid='ignore'):
+            rates = np.round(100 * self.totals / games, 1)
+        with open(path, 'w', newline='', encoding='utf-8') as fout:
+            writer = csv.writer(fout, delimiter=',')
+            writer.writerow([''] + self.characters)
+            for i, name in enumerate(self.characters):
+                writer.writerow([name] + [str(rates[i, j]) if games[i, j] else '' for j in range(len(self.characters))])
+
+
 class StatsLoader:
+    """
+    Only one process on the host fetches stats from Sheets and writes the files,
+    the other shard processes read what it writes
+    """
+    CACHE_VERSION = 3
+    WAIT_SECONDS = 5
+    WAIT_LIMIT_SECONDS = 120
+
     def __init__(self):
         self.last_update = datetime.min
         self.tables_path = os.path.join(ROOT_DIR, 'resources/AllTables.json')
         self.stats_path = os.path.join(ROOT_DIR, 'resources/stats.csv')
+        self.cache_path = os.path.join(ROOT_DIR, 'resources/stats_cache.json')
+        self.winrates_path = os.path.join(ROOT_DIR, 'resources/winrates.csv')
+        self.lock_path = os.path.join(ROOT_DIR, 'resources/stats.lock')
+        self.leader_lock = None
+        self.cache_mtime = None
         self.UPDATE_TIME_SECONDS = 600
+        self.refresh_lock = asyncio.Lock()
+        self.refresh_task = None
+        self.cache = None
+        self.matrix = None
+        self.ratings = dict()
+
+    def start(self):
+        """
+        Keep stats fresh in the background
+        """
+        if self.refresh_task is None:
+            self.refresh_task = asyncio.ensure_future(self.__refresh_loop())
+
+    async def __refresh_loop(self):
+        while True:
+            try:
+                await self.refresh()
+            except Exception as err:
+                print(err)
+            await asyncio.sleep(self.UPDATE_TIME_SECONDS)
+
+    def leader(self):
+        # Checked on every refresh, so another process takes over when the leader is gone
+        if self.leader_lock is None:
+            self.leader_lock = try_lock(self.lock_path)
+        return self.leader_lock is not None
 
-    def load_stats(self):
-        cur_time = datetime.now()
-        if (cur_time - self.last_update).total_seconds() < self.UPDATE_TIME_SECONDS:
+    def reload(self):
+        """
+        Pick up stats written by the leader, if they changed since the last look
+        """
+        try:
+            mtime = os.path.getmtime(self.cache_path)
+        except OSError:
+            return
+        if mtime == self.cache_mtime:
+            return
+        cache = self.__load_cache()
+        if not cache:
+            return
+        self.cache = cache
+        self.cache_mtime = mtime
+        self.ratings = dict()
+        self.matrix = MatchupMatrix(unmatched.get_roster(), list(cache.values()))
+        self.last_update = datetime.now()
+
+    def ready(self):
+        return os.path.isfile(self.stats_path) and os.path.isfile(self.winrates_path)
+
+    async def load_stats(self):
+        """
+        Path of stats.csv, None if the stats are still missing after WAIT_LIMIT_SECONDS
+        """
+        # A fresh process builds the matrix from the persisted cache instead of waiting for Sheets
+        if self.matrix is None:
+            self.reload()
+        # The last good files are served right away, stale ones are refreshed in the background
+        if self.ready() and self.matrix is not None:
+            cur_time = datetime.now()
+            if (cur_time - self.last_update).total_seconds() >= self.UPDATE_TIME_SECONDS and \
+                    not self.refresh_lock.locked():
+                asyncio.ensure_future(self.refresh())
             return self.stats_path
+        # Another process may be doing the fetching, wait for its first files but not forever
+        deadline = time.monotonic() + self.WAIT_LIMIT_SECONDS
+        while True:
+            try:
+                await self.refresh()
+            except Exception as err:
+                print(err)
+            if self.ready() and self.matrix is not None:
+                return self.stats_path
+            if time.monotonic() >= deadline:
+                return None
+            await asyncio.sleep(self.WAIT_SECONDS)
+
+    def __load_cache(self):
+        try:
+            with open(self.cache_path, 'r', encoding='utf-8') as fin:
+                data = json.load(fin)
+            if data.get('version') != self.CACHE_VERSION:
+                return dict()
+            return {key: SheetStats.load(part) for key, part in data['sheets'].items()}
+        except (OSError, ValueError, KeyError):
+            return dict()
+
+    def __dump_cache(self):
+        tmp_path = self.cache_path + '.tmp'
+        with open(tmp_path, 'w', encoding='utf-8') as fout:
+            json.dump({'version': self.CACHE_VERSION,
+                       'sheets': {key: part.dump() for key, part in self.cache.items()}}, fout, ensure_ascii=False)
+        os.replace(tmp_path, self.cache_path)
 
-        self.last_update = cur_time
-        with open(self.tables_path, 'r', encoding='utf-8') as fin:
-            data = json.load(fin)
+    async def __update_table(self, table):
+        """
+        Fetch rows appended since the cached cursors, re-reading the last known row to detect shrunk sheets
+        """
+        sheets = table['sheets']
+        keys = [table['id'] + '/' + sheet for sheet in sheets]
+        parts = [self.cache.get(key, SheetStats()) for key in keys]
+        starts = [max(part.rows - 1, 0) for part in parts]
+        logs = await load_logs_async(table['id'], sheets, starts)
 
-        stats = dict()
-        for table in data['tables']:
-            for sheet in table['sheets']:
-                logger = SpreadsheetGameLogger(table['id'], sheet, None)
-                results = logger.load_results(get_stats=True)
-                for winner, loser in results:
+        stale = []
+        for i, rows in enumerate(logs):
+            part = parts[i]
+            if part.rows > 0:
+                if not rows or rows[0] != part.last:
+                    stale.append(i)
+                    continue
+                rows = rows[1:]
+            part.add_rows(rows)
+            self.cache[keys[i]] = part
+
+        if stale:
+            logs = await load_logs_async(table['id'], [sheets[i] for i in stale])
+            for i, rows in zip(stale, logs):
+                part = SheetStats()
+                part.add_rows(rows)
+                self.cache[keys[i]] = part
+        return keys
+
+    async def refresh(self):
+        if not self.leader():
+            self.reload()
+            return
+        async with self.refresh_lock:
+            with open(self.tables_path, 'r', encoding='utf-8') as fin:
+                data = json.load(fin)
+            if self.cache is None:
+                self.cache = self.__load_cache()
+
+            jobs = [self.__update_table(table) for table in data['tables']]
+            keys = [key for table_keys in await asyncio.gather(*jobs) for key in table_keys]
+            # Sheets removed from the table list are dropped
+            self.cache = {key: self.cache[key] for key in keys}
+            self.__dump_cache()
+            self.cache_mtime = os.path.getmtime(self.cache_path)
+
+            stats = dict()
+            for key in keys:
+                for (winner, loser, _), count in self.cache[key].stats.items():
                     flipped = False
                     if winner > loser:
                         flipped = True
                         winner, loser = loser, winner
-                    key = (winner, loser)
-                    if key not in stats:
-                        stats[key] = [0, 0]
+                    pair = (winner, loser)
+                    if pair not in stats:
+                        stats[pair] = [0, 0]
                     if flipped:
-                        stats[key][1] += 1
+                        stats[pair][1] += count
                     else:
-                        stats[key][0] += 1
+                        stats[pair][0] += count
 
-        with open(self.stats_path, 'w',  newline='', encoding='utf-8') as fout:
-            writer = csv.writer(fout, delimiter=',')
-            for key, score in stats.items():
-                writer.writerow([key[0], key[1], score[0], score[1]])
-        return self.stats_path
+            tmp_path = self.stats_path + '.tmp'
+            with open(tmp_path, 'w', newline='', encoding='utf-8') as fout:
+                writer = csv.writer(fout, delimiter=',')
+                for key, score in stats.items():
+                    writer.writerow([key[0], key[1], score[0], score[1]])
+            os.replace(tmp_path, self.stats_path)
+
+            self.ratings = dict()
+            self.matrix = MatchupMatrix(unmatched.get_roster(), [self.cache[key] for key in keys])
+            tmp_path = self.winrates_path + '.tmp'
+            self.matrix.export_winrates(tmp_path)
+            os.replace(tmp_path, self.winrates_path)
+            self.last_update = datetime.now()
+
+    def player_ratings(self, system):
+        """
+        Players rated over the whole history of all tables, recomputed once per refresh
+        """
+        if self.cache is None:
+            return None
+        if system not in self.ratings:
+            games = [game for part in self.cache.values() for game in part.games]
+            games.sort(key=lambda game: game[2])
+            self.ratings[system] = batch_ratings(games, system)
+        return self.ratings[system]
@@ -1,26 +1,95 @@
 import Levenshtein as lev
 import json
 import os
+from collections import OrderedDict
 from rating import *
 from spreadsheets import SpreadsheetGameLogger
-from utils import ROOT_DIR
+from sqlite_storage import SqliteGameLogger
+from journal import TournamentJournal
+from standings import StandingsIndex
+from history import MatchHistory
+from utils import ROOT_DIR, RecentIds
+import asyncio
 
 
 class UMException(Exception):
     pass
 
 
-def search(name, items):
-    name = ''.join(name.lower().split())
-    res = ''
-    dist = 10 ** 9
-    for item in items:
-        for alias in item["aliases"] + [item["name"]]:
-            new_dist = lev.distance(name, ''.join(alias.lower().split()))
-            if new_dist < dist:
-                dist = new_dist
-                res = item["name"]
-    return res
+def normalize(name):
+    return ''.join(name.lower().split())
+
+
+class SearchIndex:
+    CACHE_SIZE = 1024
+
+    def __init__(self, items):
+        self.names = []
+        self.exact = {}
+        self.root = None
+        for item in items:
+            for alias in item["aliases"] + [item["name"]]:
+                key = normalize(alias)
+                if key in self.exact:
+                    continue
+                self.exact[key] = len(self.names)
+                self.names.append(item["name"])
+                self.__add(key, self.exact[key])
+        self.cache = OrderedDict()
+        self.lock = RLock()
+
+    def __add(self, key, order):
+        # BK-tree node: [alias, order, {distance: child}]
+        node = [key, order, {}]
+        if self.root is None:
+            self.root = node
+            return
+        cur = self.root
+        while True:
+            dist = lev.distance(key, cur[0])
+            if dist not in cur[2]:
+                cur[2][dist] = node
+                return
+            cur = cur[2][dist]
+
+    def __nearest(self, key):
+        # Ties are resolved by alias order, as the linear scan used to do.
+        # Stack entries carry the triangle inequality lower bound of the node distance
+        best_dist = 10 ** 9
+        best_order = -1
+        stack = [(0, self.root)]
+        while stack:
+            bound, node = stack.pop()
+            if bound > best_dist:
+                continue
+            alias, order, children = node
+            dist = lev.distance(key, alias)
+            if dist < best_dist or (dist == best_dist and order < best_order):
+                best_dist = dist
+                best_order = order
+            candidates = [(abs(dist - edge), child) for edge, child in children.items()
+                          if abs(dist - edge) <= best_dist]
+            candidates.sort(key=lambda x: -x[0])
+            stack += candidates
+        return self.names[best_order]
+
+    def search(self, name):
+        with self.lock:
+            if name in self.cache:
+                self.cache.move_to_end(name)
+                return self.cache[name]
+        key = normalize(name)
+        if key in self.exact:
+            res = self.names[self.exact[key]]
+        elif self.root is None:
+            res = ''
+        else:
+            res = self.__nearest(key)
+        with self.lock:
+            self.cache[name] = res
+            if len(self.cache) > self.CACHE_SIZE:
+                self.cache.popitem(last=False)
+        return res
 
 
 class Roster:
@@ -30,111 +99,221 @@ class Roster:
             data = json.load(fin)
         self.characters = data['characters']
         self.boards = data['boards']
+        self.character_index = SearchIndex(self.characters)
+        self.board_index = SearchIndex(self.boards)
 
     def parse_character(self, name):
-        return search(name, self.characters)
+        return self.character_index.search(name)
 
     def parse_board(self, name):
-        return search(name, self.boards)
+        return self.board_index.search(name)
+
 
+ROSTER = None
+ROSTER_LOCK = RLock()
 
-ROSTER = Roster()
+
+def get_roster():
+    # The roster is indexed on first use, not when the bot starts
+    global ROSTER
+    if ROSTER is None:
+        with ROSTER_LOCK:
+            if ROSTER is None:
+                ROSTER = Roster()
+    return ROSTER
 
 
 def reload_roster():
+    # The new roster is fully indexed before it replaces the old one
     global ROSTER
-    ROSTER = Roster()
+    roster = Roster()
+    with ROSTER_LOCK:
+        ROSTER = roster
 
 
 class Match:
     def __init__(self, winner, loser, win_char, lose_char, board, winner_first):
         self.winner = winner
         self.loser = loser
-        self.winner_character = ROSTER.parse_character(win_char)
-        self.loser_character = ROSTER.parse_character(lose_char)
-        self.board = ROSTER.parse_board(board)
+        roster = get_roster()
+        self.winner_character = roster.parse_character(win_char)
+        self.loser_character = roster.parse_character(lose_char)
+        self.board = roster.parse_board(board)
         self.winner_first = winner_first
+        # Time the match was reported, if it is recorded later than that
+        self.played_at = None
 
 
 class Tournament:
+    SNAPSHOT_EVERY = 20
+    RECORDED_LIMIT = 10000
+    PAGE_SIZE = 15
+
     def __init__(self):
         self.lock = RLock()
+        # Reports are applied one at a time, in the order they arrive
+        self.report_lock = asyncio.Lock()
+        self.recorded = RecentIds(self.RECORDED_LIMIT)
         self.name = ""
         self.characters = []
         self.boards = []
         self.rating = None
+        self.rating_type = ""
         self.standings = {}
+        self.index = StandingsIndex()
+        # Rendered standings pages, dropped when a rank shown on them changes
+        self.pages = dict()
+        self.history = MatchHistory()
         self.logger = None
+        self.journal = None
+        self.cursor = 0
         self.dummy = ""
 
-    def __load_state(self):
-        matches = self.logger.load_results()
-        for winner, loser in matches:
-            if winner not in self.standings:
-                self.standings[winner] = self.rating.default_rank()
-            if loser not in self.standings:
-                self.standings[loser] = self.rating.default_rank()
-
-            w_rank = self.standings[winner]
-            l_rank = self.standings[loser]
-            new_w_rank, new_l_rank = self.rating.update_rank(w_rank, l_rank)
-            self.standings[winner] = new_w_rank
-            self.standings[loser] = new_l_rank
-
-    def start(self, name):
+    def __rate(self, winner, loser):
+        """
+        Ranks of both players before and after the match, standings are left as they are
+        """
+        w_rank = self.standings[winner] if winner in self.standings else self.rating.default_rank()
+        l_rank = self.standings[loser] if loser in self.standings else self.rating.default_rank()
+        new_w_rank, new_l_rank = self.rating.update_rank(w_rank, l_rank)
+        return w_rank, l_rank, new_w_rank, new_l_rank
+
+    def __store(self, winner, loser, new_w_rank, new_l_rank):
+        self.standings[winner] = new_w_rank
+        self.standings[loser] = new_l_rank
+        self.__invalidate_pages(self.index.update(winner, self.rating.to_number(new_w_rank)))
+        self.__invalidate_pages(self.index.update(loser, self.rating.to_number(new_l_rank)))
+        self.cursor += 1
+
+    def __apply_result(self, winner, loser):
+        w_rank, l_rank, new_w_rank, new_l_rank = self.__rate(winner, loser)
+        self.__store(winner, loser, new_w_rank, new_l_rank)
+        return w_rank, l_rank, new_w_rank, new_l_rank
+
+    def __invalidate_pages(self, changed):
+        if self.pages:
+            lo, hi = changed
+            for page in range(lo // self.PAGE_SIZE, hi // self.PAGE_SIZE + 1):
+                self.pages.pop(page, None)
+
+    def __dump_snapshot(self):
+        self.journal.dump_snapshot({
+            'rating': self.rating_type,
+            'cursor': self.cursor,
+            'rating_state': self.rating.dump_state(),
+            'standings': [[name, self.rating.dump_rank(rank)] for name, rank in self.standings.items()]
+        })
+
+    def __restore_snapshot(self, snapshot):
+        self.rating.load_state(snapshot['rating_state'])
+        self.standings = {name: self.rating.load_rank(rank) for name, rank in snapshot['standings']}
+        self.index = StandingsIndex()
+        for name, rank in self.standings.items():
+            self.index.update(name, self.rating.to_number(rank))
+        self.pages = dict()
+        self.cursor = snapshot['cursor']
+
+    async def __load_state(self):
+        rows = self.journal.read()
+        # Re-read the last known row to check that the sheet still matches the journal
+        tail = await self.logger.load_log_async(max(len(rows) - 1, 0))
+        if rows:
+            if tail and tail[0][1:6] == rows[-1][1:6]:
+                tail = tail[1:]
+            else:
+                self.journal.reset()
+                rows = []
+                tail = await self.logger.load_log_async()
+
+        snapshot = self.journal.load_snapshot()
+        if snapshot is not None and snapshot['rating'] == self.rating_type and snapshot['cursor'] <= len(rows):
+            self.__restore_snapshot(snapshot)
+
+        for row in rows[self.cursor:] + tail:
+            self.__apply_result(row[1], row[2])
+        self.history.add_rows(rows)
+        self.history.add_rows(tail)
+        # Rows of reported messages carry the message id after the sheet columns
+        for row in rows + tail:
+            if len(row) > 8:
+                self.recorded.add(row[8])
+        self.journal.append(tail)
+        self.__dump_snapshot()
+
+    async def start(self, name):
+        cfg_file = os.path.join(ROOT_DIR, "resources/" + name + ".json")
+        if not os.path.isfile(cfg_file):
+            raise UMException("Tournament config file not found")
+        with open(cfg_file, "r", encoding='utf-8') as fin:
+            cfg = json.load(fin)
+        await self.start_with_config(name, cfg)
+
+    def make_logger(self, cfg):
+        storage = cfg.get("storage", "sheets")
+        standings_sheet = None
+        if "standings_sheet" in cfg:
+            standings_sheet = cfg["standings_sheet"]
+
+        if storage == "sheets":
+            if "spreadsheet_id" not in cfg:
+                raise UMException("Missing spreadsheet_id")
+            if "log_sheet" not in cfg:
+                raise UMException("Missing log_sheet name")
+            return SpreadsheetGameLogger(cfg["spreadsheet_id"], cfg["log_sheet"], standings_sheet, self.name)
+        elif storage == "sqlite":
+            db_path = os.path.join(ROOT_DIR, "resources/" + cfg.get("database", "games.db"))
+            mirror = None
+            source = None
+            if "spreadsheet_id" in cfg and standings_sheet is not None:
+                mirror = SpreadsheetGameLogger(cfg["spreadsheet_id"], None, standings_sheet, self.name)
+            if "spreadsheet_id" in cfg and "log_sheet" in cfg:
+                source = SpreadsheetGameLogger(cfg["spreadsheet_id"], cfg["log_sheet"], None, self.name)
+            return SqliteGameLogger(db_path, self.name, mirror, source)
+        else:
+            raise UMException("Unknown storage type: " + str(storage))
+
+    async def start_with_config(self, name, cfg):
         self.name = name
+        roster = get_roster()
         with self.lock:
-            cfg_file = os.path.join(ROOT_DIR, "resources/" + name + ".json")
-            if not os.path.isfile(cfg_file):
-                raise UMException("Tournament config file not found")
-            with open(cfg_file, "r", encoding='utf-8') as fin:
-                cfg = json.load(fin)
-
             if "characters" in cfg:
                 if cfg["characters"] == 'all':
-                    self.characters = [x["name"] for x in ROSTER.characters]
+                    self.characters = [x["name"] for x in roster.characters]
                 else:
-                    self.characters = [ROSTER.parse_character(x) for x in cfg["characters"]]
+                    self.characters = [roster.parse_character(x) for x in cfg["characters"]]
             elif "character-bans" in cfg:
-                all_chars = set([x["name"] for x in ROSTER.characters])
-                bans = set([ROSTER.parse_character(x) for x in cfg["character-bans"]])
+                all_chars = set([x["name"] for x in roster.characters])
+                bans = set([roster.parse_character(x) for x in cfg["character-bans"]])
                 self.characters = list(all_chars - bans)
             else:
                 raise UMException("Missing character list")
 
             if "boards" in cfg:
                 if cfg["boards"] == 'all':
-                    self.boards = [x["name"] for x in ROSTER.boards]
+                    self.boards = [x["name"] for x in roster.boards]
                 else:
-                    self.boards = [ROSTER.parse_board(x) for x in cfg["boards"]]
+                    self.boards = [roster.parse_board(x) for x in cfg["boards"]]
             elif "board-bans" in cfg:
-                all_boards = set([x["name"] for x in ROSTER.boards])
-                bans = set([ROSTER.parse_board(x) for x in cfg["board-bans"]])
+                all_boards = set([x["name"] for x in roster.boards])
+                bans = set([roster.parse_board(x) for x in cfg["board-bans"]])
                 self.boards = list(all_boards - bans)
             else:
                 raise UMException("Missing boards list")
 
-            if "rating" not in cfg:
-                self.rating = EmptyRankManager()
-            elif cfg["rating"] == "counter":
-                self.rating = CounterRankManager()
-            elif cfg["rating"] == "ladder":
-                self.rating = LadderRankManager()
-            else:
+            self.rating_type = cfg.get("rating", "")
+            self.rating = make_rank_manager(self.rating_type)
+            if self.rating is None:
                 raise UMException("Unknown rating type: " + str(cfg["rating"]))
             self.dummy = self.rating.default_rank()
 
-            if "spreadsheet_id" not in cfg:
-                raise UMException("Missing spreadsheet_id")
-            if "log_sheet" not in cfg:
-                raise UMException("Missing log_sheet name")
-            standings_sheet = None
-            if "standings_sheet" in cfg:
-                standings_sheet = cfg["standings_sheet"]
-            self.logger = SpreadsheetGameLogger(cfg["spreadsheet_id"], cfg["log_sheet"], standings_sheet)
-            self.__load_state()
+            self.logger = self.make_logger(cfg)
+            self.journal = TournamentJournal(name)
+        await self.__load_state()
 
-    def report_match(self, match):
+    async def report_match(self, match, message_id=None):
+        """
+        Returns False if the message has already been recorded
+        """
         if match.winner_character == match.loser_character:
             raise UMException("Mirror matches are forbidden")
         if match.winner_character not in self.characters:
@@ -144,24 +323,36 @@ class Tournament:
         if match.board not in self.boards:
             raise UMException("Forbidden board: " + match.board)
 
-        if match.winner not in self.standings:
-            self.standings[match.winner] = self.rating.default_rank()
-        if match.loser not in self.standings:
-            self.standings[match.loser] = self.rating.default_rank()
+        async with self.report_lock:
+            if message_id is not None and message_id in self.recorded:
+                return False
 
-        is_rated = True
-        w_rank = self.standings[match.winner]
-        l_rank = self.standings[match.loser]
-        new_w_rank, new_l_rank = self.rating.update_rank(w_rank, l_rank)
-        if self.rating.to_number(w_rank) == self.rating.to_number(new_w_rank) and \
-                self.rating.to_number(l_rank) == self.rating.to_number(new_l_rank):
-            is_rated = False
-        self.standings[match.winner] = new_w_rank
-        self.standings[match.loser] = new_l_rank
+            # Standings only change once the row is in the log, so a failed write can simply be retried
+            rating_state = self.rating.dump_state()
+            w_rank, l_rank, new_w_rank, new_l_rank = self.__rate(match.winner, match.loser)
+            is_rated = True
+            if self.rating.to_number(w_rank) == self.rating.to_number(new_w_rank) and \
+                    self.rating.to_number(l_rank) == self.rating.to_number(new_l_rank):
+                is_rated = False
+            try:
+                row = await self.logger.log_match_async(match, is_rated)
+            except Exception:
+                self.rating.load_state(rating_state)
+                raise
 
-        self.logger.log_match(match, is_rated)
-        stand = sorted(list(self.standings.items()), key=lambda x: self.rating.to_number(x[1]), reverse=True)
-        self.logger.update_standings(stand)
+            self.__store(match.winner, match.loser, new_w_rank, new_l_rank)
+            if message_id is not None:
+                self.recorded.add(message_id)
+            self.history.add_row(row)
+            try:
+                self.journal.append([row + [message_id]] if message_id is not None else [row])
+                if self.cursor % self.SNAPSHOT_EVERY == 0:
+                    self.__dump_snapshot()
+            except OSError as err:
+                # The log has the row, the journal catches up from it on the next start
+                print(err)
+            await self.logger.update_standings_async(self.sorted_standings())
+            return True
 
     def get_rank(self, player):
         if player in self.standings:
@@ -175,12 +366,30 @@ class Tournament:
         r1, r2 = self.rating.update_rank(w_rank, l_rank)
         return str(r1), str(r2)
 
+    def sorted_standings(self):
+        return [(player, self.standings[player]) for player in self.index.players()]
+
+    def get_place(self, player):
+        return self.index.position(player)
+
+    def get_top(self, count):
+        return [(player, self.index.position(player), str(self.standings[player]))
+                for player in self.index.top(count)]
+
+    def page_count(self):
+        return max((len(self.index) + self.PAGE_SIZE - 1) // self.PAGE_SIZE, 1)
+
+    def get_standings_page(self, page):
+        """
+        Text of a 0-based standings page, rendered once and kept until one of its lines changes
+        """
+        text = self.pages.get(page)
+        if text is None:
+            players = self.index.page(page * self.PAGE_SIZE, self.PAGE_SIZE)
+            text = '\n'.join(f'{self.index.position(player)}. {player} - {self.standings[player]}'
+                             for player in players)
+            self.pages[page] = text
+        return text
+
     def get_winners(self):
-        stand = sorted(list(self.standings.items()), key=lambda x: self.rating.to_number(x[1]), reverse=True)
-        res = []
-        for player, rank in stand:
-            if self.rating.to_number(rank) == self.rating.to_number(stand[0][1]):
-                res.append(player)
-            else:
-                break
-        return res
+        return self.index.leaders()
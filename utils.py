@@ -1,3 +1,64 @@
+from collections import OrderedDict
+import fcntl
 import os
+import time
 
 ROOT_DIR = os.path.dirname(os.path.abspath(__file__))
+
+
+def try_lock(path):
+    """
+    Exclusive lock on a file shared by the processes on this host, held until the returned file is closed
+    or the process exits. None if another live process holds it
+    """
+    fout = open(path, 'a')
+    try:
+        fcntl.flock(fout, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except OSError:
+        fout.close()
+        return None
+    return fout
+
+
+class RecentIds:
+    """
+    Set of ids that forgets the oldest ones beyond the limit
+    """
+    def __init__(self, limit):
+        self.limit = limit
+        self.ids = OrderedDict()
+
+    def __contains__(self, id):
+        return id in self.ids
+
+    def __len__(self):
+        return len(self.ids)
+
+    def add(self, id):
+        self.ids[id] = None
+        self.ids.move_to_end(id)
+        if len(self.ids) > self.limit:
+            self.ids.popitem(last=False)
+
+
+class StartupReport:
+    """
+    How long each startup phase took, counted from the first import of this module
+    """
+    def __init__(self):
+        self.last = time.perf_counter()
+        self.phases = []
+        self.finished = False
+
+    def phase(self, name):
+        now = time.perf_counter()
+        self.phases.append((name, now - self.last))
+        self.last = now
+
+    def render(self):
+        total = sum(seconds for _, seconds in self.phases)
+        lines = [f'{name}: {seconds:.3f}s' for name, seconds in self.phases]
+        return '\n'.join(lines + [f'total: {total:.3f}s'])
+
+
+STARTUP = StartupReport()